@@ -1,9 +1,16 @@
-import json
+import argparse
+import asyncio
+import hashlib
 import os
-from openai import OpenAI
+import orjson
+import re
+import shelve
+import time
+import tiktoken
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv
 from datetime import datetime
-import time
+from collections import defaultdict
 
 # --- Configuration ---
 load_dotenv() # Loads environment variables from .env file
@@ -14,16 +21,166 @@ if not api_key:
     print("ERROR: OPENAI_API_KEY not found in .env file. Please create .env and set it.")
     exit()
 
+# Async client so many conversations can be summarized concurrently.
+# The client retries 429/5xx responses with exponential backoff on its own.
+aclient = AsyncOpenAI(api_key=api_key, max_retries=5)
+# Sync client for the Batch API (file upload, batch creation and polling).
 client = OpenAI(api_key=api_key)
 
 # --- File Paths ---
 BASE_OUTPUT_DIR = "flattened_output" # Ensure this directory exists
 METADATA_PATH = os.path.join(BASE_OUTPUT_DIR, "zain_metadata.json") # Corrected from your previous streamlit_app.py which used zain_metadata.json
 OUTPUT_INSIGHTS_PATH = os.path.join(BASE_OUTPUT_DIR, "precalculated_insights.json")
+BATCH_INPUT_PATH = os.path.join(BASE_OUTPUT_DIR, "batch_input.jsonl") # Requests uploaded to the Batch API
+LLM_CACHE_PATH = os.path.join(BASE_OUTPUT_DIR, "llm_cache") # shelve cache of LLM results keyed by input hash
 
 # --- Model Configuration ---
-CHAT_MODEL_FOR_SUMMARY = "gpt-3.5-turbo" # Default: cost-effective and fast
-# CHAT_MODEL_FOR_SUMMARY = "gpt-4-turbo-preview" # Alternative: higher quality, higher cost, slower
+# Short conversations go to the cheap model; long ones (and replies the cheap model
+# formats badly) are escalated to the larger model.
+CHAT_MODEL_FOR_SUMMARY = "gpt-4o-mini" # Default: cost-effective and fast
+CHAT_MODEL_FOR_LONG_SUMMARY = "gpt-4o" # Higher quality, higher cost, slower
+LONG_CONVERSATION_TOKENS = 3000 # Conversations with at least this many tokens use CHAT_MODEL_FOR_LONG_SUMMARY
+
+# Static instructions + few-shot examples. This must stay byte-identical across calls (no
+# f-strings, dates or IDs) and comes before the conversation text, so OpenAI's automatic
+# prompt caching (prefixes of 1024+ tokens) can reuse it instead of reprocessing it per call.
+SYSTEM_PROMPT = (
+    "You are an expert at analyzing conversation transcripts. "
+    "Your task is to provide a concise one-sentence summary of the entire conversation "
+    "and then list exactly 5 distinct and most important keywords or keyphrases from it. "
+    "Respond with a JSON object with two fields:\n"
+    "\"summary\": your one-sentence summary\n"
+    "\"keywords\": an array of exactly 5 keyword strings\n"
+    "\n"
+    "## Input\n"
+    "The user message contains a transcript of one conversation between a person (lines starting "
+    "with 'User:') and an AI assistant (lines starting with 'Assistant:'), in chronological order. "
+    "Very long conversations may contain a line such as '...[12 middle messages elided]...' where "
+    "messages were removed to save space; summarize what is present and do not speculate about "
+    "the missing part. Transcripts can contain code, logs, tables, URLs or text in languages other "
+    "than English.\n"
+    "\n"
+    "## Summary guidelines\n"
+    "- Write exactly one sentence, ideally between 15 and 35 words.\n"
+    "- Describe what the person wanted and what the conversation produced or concluded, "
+    "for example a decision, a fix, an explanation, a plan or a piece of writing.\n"
+    "- Refer to the participants as 'the user' and 'the assistant'; never invent names.\n"
+    "- Prefer concrete nouns (tools, libraries, places, products, concepts) over vague words "
+    "such as 'various topics' or 'some questions'.\n"
+    "- If the conversation covers several unrelated requests, name the main one first and "
+    "mention the others briefly in the same sentence.\n"
+    "- Do not quote the transcript, do not add opinions, and do not describe the format of the "
+    "transcript itself.\n"
+    "- Always write the summary in English, even if the conversation is in another language.\n"
+    "\n"
+    "## Keyword guidelines\n"
+    "- Give exactly 5 keywords or short keyphrases (1 to 4 words each), one per array item.\n"
+    "- Order them from most to least important for finding this conversation again later.\n"
+    "- Each keyword must be distinct: no synonyms, plurals or near-duplicates of another keyword.\n"
+    "- Prefer specific terms (e.g. 'FAISS', 'rate limiting', 'sourdough starter') over generic "
+    "ones (e.g. 'technology', 'help', 'question', 'conversation').\n"
+    "- Keep the original spelling and capitalization of proper nouns, product names and code "
+    "identifiers; write other keywords in lowercase.\n"
+    "- Do not add extra quotes, brackets, bullets or numbering inside a keyword.\n"
+    "\n"
+    "## Edge cases\n"
+    "- If the conversation is mostly code, summarize what the code does or what problem it solves, "
+    "and use the relevant language, framework or error names as keywords.\n"
+    "- If the user only greeted the assistant or the conversation ended before anything was "
+    "answered, say so plainly in the summary and use the subject the user raised as keywords.\n"
+    "- If the assistant refused or could not help, state what was requested and that it was not "
+    "completed.\n"
+    "- If the conversation is about personal or sensitive matters, summarize neutrally and factually "
+    "without repeating private details such as addresses, phone numbers or account numbers.\n"
+    "\n"
+    "## Output rules\n"
+    "- Output only the JSON object with the summary and keywords fields.\n"
+    "- Do not use headings, markdown or explanations inside the strings.\n"
+    "- Even for very short or trivial conversations, still fill in both fields.\n"
+    "\n"
+    "## Examples\n"
+    "\n"
+    "Example transcript 1:\n"
+    "User: My Flask app returns 502 errors behind nginx after about 60 seconds when generating reports.\n"
+    "Assistant: That matches nginx's default proxy_read_timeout of 60s. Increase proxy_read_timeout "
+    "in the location block, and consider moving report generation to a background worker such as "
+    "Celery so the request returns immediately.\n"
+    "User: I'll try the timeout first. Where exactly does it go?\n"
+    "Assistant: Inside the location / block that contains proxy_pass, e.g. proxy_read_timeout 300s; "
+    "then reload nginx with sudo nginx -s reload.\n"
+    "Example response 1:\n"
+    "{\"summary\": \"The user diagnosed 502 errors from a Flask app behind nginx, and the assistant traced "
+    "them to the 60-second proxy_read_timeout and suggested raising it or using a Celery background worker.\", "
+    "\"keywords\": [\"nginx proxy_read_timeout\", \"502 Bad Gateway\", \"Flask\", \"Celery\", \"report generation\"]}\n"
+    "\n"
+    "Example transcript 2:\n"
+    "User: Can you help me plan a 5-day trip to Lisbon in October on a moderate budget?\n"
+    "Assistant: Sure. Days 1-2: Alfama, Baixa and Belem; day 3: a day trip to Sintra; day 4: LX "
+    "Factory and the riverside; day 5: Cascais. Stay in Baixa or Graca, use a Viva Viagem card for "
+    "transport, and budget roughly 100-150 EUR per day.\n"
+    "User: Is Sintra doable without a car?\n"
+    "Assistant: Yes, trains leave Rossio station every 20-30 minutes and take about 40 minutes; "
+    "go early to beat the crowds at Pena Palace.\n"
+    "Example response 2:\n"
+    "{\"summary\": \"The user asked for a moderate-budget five-day Lisbon itinerary for October, and the "
+    "assistant proposed a day-by-day plan including a car-free train day trip to Sintra.\", "
+    "\"keywords\": [\"Lisbon itinerary\", \"Sintra day trip\", \"Pena Palace\", \"travel budget\", \"Viva Viagem card\"]}\n"
+    "\n"
+    "Example transcript 3:\n"
+    "User: Explain the difference between a list and a tuple in Python.\n"
+    "Assistant: Lists are mutable and typically hold items of the same kind that change over time; "
+    "tuples are immutable, hashable when their contents are hashable, and often used for fixed "
+    "records or as dictionary keys.\n"
+    "User: So I should use a tuple for coordinates?\n"
+    "Assistant: Yes, a tuple like (x, y) is a good fit because the pair is fixed and can be used as a "
+    "dict key; a namedtuple or dataclass adds field names if you need them.\n"
+    "Example response 3:\n"
+    "{\"summary\": \"The user asked how Python lists and tuples differ, and the assistant explained "
+    "mutability and hashability and recommended tuples or namedtuples for fixed coordinate pairs.\", "
+    "\"keywords\": [\"Python tuple\", \"Python list\", \"immutability\", \"hashable dictionary keys\", \"namedtuple\"]}"
+)
+
+# Structured Outputs: the model is constrained to emit JSON matching this schema,
+# so no free-text parsing (and no retries for reformatted replies) is needed.
+INSIGHTS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "insights",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "summary": {"type": "string", "description": "One-sentence summary of the conversation."},
+                "keywords": {"type": "array", "items": {"type": "string"}, "description": "Exactly 5 keywords or keyphrases."}
+            },
+            "required": ["summary", "keywords"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# --- Input Budget ---
+# Long conversations are trimmed to their opening and closing messages so each call
+# stays well inside the context window and the input token bill stays bounded.
+MAX_INPUT_TOKENS = 6000
+try:
+    enc = tiktoken.encoding_for_model(CHAT_MODEL_FOR_SUMMARY)
+except KeyError: # Model unknown to this tiktoken version
+    enc = tiktoken.get_encoding("cl100k_base")
+
+# --- Batch API Configuration ---
+# The Batch API completes within 24h at half the price of real-time Chat Completions.
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_INTERVAL_SECONDS = 60 # How often to check on a submitted batch
+BATCH_PENDING_STATUSES = {"validating", "in_progress", "finalizing", "cancelling"}
+
+# --- Concurrency Configuration (--interactive mode) ---
+MAX_CONCURRENT_REQUESTS = 20 # Number of LLM calls kept in flight at once
+SAVE_EVERY_N_INSIGHTS = 5 # Flush insights to disk after this many new results
+# Pacing follows the x-ratelimit-* headers on each response: requests go out back-to-back
+# while quota remains, and pause until the reported reset once it drops below these reserves.
+RATE_LIMIT_RESERVE_REQUESTS = MAX_CONCURRENT_REQUESTS
+RATE_LIMIT_RESERVE_TOKENS = 20000
 
 # --- Test Configuration ---
 # Set TEST_SUBSET_SIZE to a small number (e.g., 3, 5, 10) for initial testing.
@@ -31,26 +188,40 @@ CHAT_MODEL_FOR_SUMMARY = "gpt-3.5-turbo" # Default: cost-effective and fast
 TEST_SUBSET_SIZE = 5 # <<< CHANGE THIS FOR MORE/LESS TESTING, OR COMMENT OUT BLOCK BELOW
 
 # --- Helper Functions ---
-def get_full_conversation_text_for_llm(conversation_id, all_metadata_list):
+def group_messages_by_conversation(all_metadata_list):
+    """
+    Builds a {conversation_id: [messages sorted by timestamp]} index in a single pass.
+    Every conversation_id gets an entry; only messages with a timestamp are kept for sorting.
+    Conversations whose timestamps cannot be sorted are left with an empty message list.
+    """
+    messages_by_conversation = defaultdict(list)
+    for msg in all_metadata_list:
+        conversation_id = msg.get("conversation_id")
+        if conversation_id is None:
+            continue
+        conversation_messages = messages_by_conversation[conversation_id]
+        if msg.get("timestamp") is not None:
+            conversation_messages.append(msg)
+
+    # Sort messages by timestamp (converted to float for safety), once per conversation
+    for conversation_id, conversation_messages in messages_by_conversation.items():
+        try:
+            conversation_messages.sort(key=lambda x: float(x["timestamp"]))
+        except (TypeError, ValueError) as e:
+            print(f"  Warning: Could not sort messages for conv_id {conversation_id} due to timestamp issue: {e}. Skipping this conversation for LLM processing.")
+            conversation_messages.clear()
+    return dict(messages_by_conversation)
+
+def get_full_conversation_text_for_llm(conversation_id, messages_by_conversation):
     """
     Extracts and formats the text of a full conversation for LLM processing.
+    messages_by_conversation is the index built by group_messages_by_conversation().
     """
-    # Filter messages for the given conversation_id and ensure they have a timestamp for sorting
-    conversation_messages = [
-        msg for msg in all_metadata_list
-        if msg.get("conversation_id") == conversation_id and msg.get("timestamp") is not None
-    ]
+    conversation_messages = messages_by_conversation.get(conversation_id)
     
     if not conversation_messages:
         # print(f"  Debug: No messages found or no timestamps for conv_id: {conversation_id}")
         return None
-
-    # Sort messages by timestamp (converted to float for safety)
-    try:
-        conversation_messages.sort(key=lambda x: float(x["timestamp"]))
-    except (TypeError, ValueError) as e:
-        print(f"  Warning: Could not sort messages for conv_id {conversation_id} due to timestamp issue: {e}. Skipping this conversation for LLM processing.")
-        return None
     
     llm_input_parts = []
     for msg in conversation_messages:
@@ -60,9 +231,120 @@ def get_full_conversation_text_for_llm(conversation_id, all_metadata_list):
             content = str(content) # Attempt to convert to string
         llm_input_parts.append(f"{role_prefix}: {content.strip()}") # Strip whitespace
         
-    return "\n".join(llm_input_parts)
+    return "\n".join(fit_to_token_budget(llm_input_parts))
+
+def fit_to_token_budget(llm_input_parts, max_tokens=MAX_INPUT_TOKENS):
+    """
+    Keeps the leading and trailing messages of a conversation within max_tokens,
+    replacing the dropped middle with a single "...[N middle messages elided]..." line.
+    """
+    # Every token covers at least one UTF-8 byte, so short conversations skip tokenization
+    if sum(len(part.encode("utf-8")) + 1 for part in llm_input_parts) <= max_tokens:
+        return llm_input_parts
+
+    token_lists = enc.encode_ordinary_batch(llm_input_parts)
+    tok_counts = [len(tokens) + 1 for tokens in token_lists] # +1 for the joining newline
+    if sum(tok_counts) <= max_tokens:
+        return llm_input_parts
+
+    budget = max_tokens - 20 # Room for the elision marker
+    head, tail = 0, len(llm_input_parts) # Keep llm_input_parts[:head] and llm_input_parts[tail:]
+    used = 0
+    take_head = True
+    while head < tail:
+        idx = head if take_head else tail - 1
+        if used + tok_counts[idx] > budget:
+            break
+        used += tok_counts[idx]
+        if take_head:
+            head += 1
+        else:
+            tail -= 1
+        take_head = not take_head
+
+    kept_head = llm_input_parts[:head]
+    if head == 0 and tail == len(llm_input_parts):
+        # Even the first message is over budget on its own: keep its beginning
+        kept_head = [enc.decode(token_lists[0][:budget])]
+        head = 1
+    elision_marker = [f"...[{tail - head} middle messages elided]..."] if tail > head else []
+    return kept_head + elision_marker + llm_input_parts[tail:]
+
+def choose_model_for_text(conversation_text):
+    """Routes a conversation to CHAT_MODEL_FOR_SUMMARY or, if it is long, CHAT_MODEL_FOR_LONG_SUMMARY."""
+    # Every token covers at least one UTF-8 byte, so short texts skip tokenization
+    if len(conversation_text.encode("utf-8")) < LONG_CONVERSATION_TOKENS:
+        return CHAT_MODEL_FOR_SUMMARY
+    if len(enc.encode_ordinary(conversation_text)) < LONG_CONVERSATION_TOKENS:
+        return CHAT_MODEL_FOR_SUMMARY
+    return CHAT_MODEL_FOR_LONG_SUMMARY
+
+def build_insight_request_body(conversation_text, model=None):
+    """
+    Builds the Chat Completions request body for one conversation.
+    Shared by the real-time path and the Batch API input file so both send identical requests.
+    If model is None it is chosen by choose_model_for_text().
+    """
+    return {
+        "model": model or choose_model_for_text(conversation_text),
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": conversation_text}
+        ],
+        "temperature": 0.2, # Lower temperature for more factual/deterministic output
+        "max_tokens": 250, # Increased slightly to ensure full summary and keywords fit
+        "response_format": INSIGHTS_RESPONSE_FORMAT
+    }
+
+def parse_insights_response(content, conversation_id_for_debug="N/A"):
+    """
+    Parses the structured JSON reply ({"summary": ..., "keywords": [...]}) from the LLM.
+    Returns (summary, keywords_list), or (None, None) if the reply is missing or truncated.
+    """
+    # print(f"  Debug (conv_id: {conversation_id_for_debug}): LLM Raw Response:\n{content}")
+    try:
+        data = orjson.loads(content)
+        summary = data["summary"].strip()
+        keywords_list = [kw.strip() for kw in data["keywords"] if kw.strip()][:5]
+    except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError):
+        # content is None for refusals, and invalid JSON if the reply hit max_tokens
+        print(f"  Warning (conv_id: {conversation_id_for_debug}): LLM returned an empty or non-parsable response for summary/keywords. Raw: {content}")
+        return None, None # Indicate failure to parse
 
-def generate_insights_for_text(conversation_text, conversation_id_for_debug="N/A"):
+    return summary, keywords_list
+
+# --- Rate Limiting (--interactive mode) ---
+rate_limit_resume_at = 0.0 # time.monotonic() value before which no new request should start
+
+def parse_reset_duration(value):
+    """Converts an x-ratelimit-reset-* header value such as '1s', '6m0s' or '20ms' to seconds."""
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(amount) * units[unit] for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value or ""))
+
+def update_rate_limits(headers):
+    """Pushes rate_limit_resume_at forward when the remaining request or token quota runs low."""
+    global rate_limit_resume_at
+    for kind, reserve in (("requests", RATE_LIMIT_RESERVE_REQUESTS), ("tokens", RATE_LIMIT_RESERVE_TOKENS)):
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        if remaining is None or int(remaining) > reserve:
+            continue
+        wait_seconds = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+        rate_limit_resume_at = max(rate_limit_resume_at, time.monotonic() + wait_seconds)
+
+async def wait_for_rate_limit():
+    """Sleeps only if a previous response reported that the quota is nearly exhausted."""
+    delay = rate_limit_resume_at - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+async def create_chat_completion(request_body):
+    """Sends one Chat Completions request, pacing it by the rate-limit headers of earlier responses."""
+    await wait_for_rate_limit()
+    raw_response = await aclient.chat.completions.with_raw_response.create(**request_body)
+    update_rate_limits(raw_response.headers)
+    return raw_response.parse()
+
+async def generate_insights_for_text(conversation_text, conversation_id_for_debug="N/A"):
     """
     Sends conversation text to OpenAI to get a one-sentence summary and 5 keywords.
     """
@@ -71,54 +353,294 @@ def generate_insights_for_text(conversation_text, conversation_id_for_debug="N/A
         return None, None
         
     try:
-        system_prompt = (
-            "You are an expert at analyzing conversation transcripts. "
-            "Your task is to provide a concise one-sentence summary of the entire conversation "
-            "and then list exactly 5 distinct and most important keywords or keyphrases from it. "
-            "Format your response strictly as follows, with each part on a new line:\n"
-            "SUMMARY: [Your one-sentence summary here]\n"
-            "KEYWORDS: [keyword1, keyword2, keyword3, keyword4, keyword5]"
-        )
-        
         # print(f"  Debug (conv_id: {conversation_id_for_debug}): Sending text to LLM starting with: {conversation_text[:200]}...")
 
-        response = client.chat.completions.create(
-            model=CHAT_MODEL_FOR_SUMMARY,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": conversation_text}
-            ],
-            temperature=0.2, # Lower temperature for more factual/deterministic output
-            max_tokens=250 # Increased slightly to ensure full summary and keywords fit
-        )
+        request_body = build_insight_request_body(conversation_text)
+        response = await create_chat_completion(request_body)
         content = response.choices[0].message.content
-        
-        # print(f"  Debug (conv_id: {conversation_id_for_debug}): LLM Raw Response:\n{content}")
-
-        summary_line = ""
-        keywords_line = ""
+        summary, keywords = parse_insights_response(content, conversation_id_for_debug)
 
-        for line in content.split('\n'):
-            if line.upper().startswith("SUMMARY:"):
-                summary_line = line.replace("SUMMARY:", "").strip()
-            elif line.upper().startswith("KEYWORDS:"):
-                keywords_line = line.replace("KEYWORDS:", "").strip()
-        
-        keywords_list = [kw.strip() for kw in keywords_line.split(',') if kw.strip()]
-        
-        if not summary_line and not keywords_list:
-            print(f"  Warning (conv_id: {conversation_id_for_debug}): LLM returned an empty or non-parsable response for summary/keywords. Raw: {content}")
-            return None, None # Indicate failure to parse
+        if summary is None and keywords is None and request_body["model"] != CHAT_MODEL_FOR_LONG_SUMMARY:
+            # Refused or truncated reply from the cheap model: retry once on the larger model
+            print(f"  Retrying conv_id {conversation_id_for_debug} with {CHAT_MODEL_FOR_LONG_SUMMARY}.")
+            response = await create_chat_completion(
+                build_insight_request_body(conversation_text, model=CHAT_MODEL_FOR_LONG_SUMMARY)
+            )
+            content = response.choices[0].message.content
+            summary, keywords = parse_insights_response(content, conversation_id_for_debug)
 
-        return summary_line, keywords_list
+        return summary, keywords
 
     except Exception as e:
         print(f"  ERROR (conv_id: {conversation_id_for_debug}): During OpenAI API call or parsing: {e}")
         return None, None
 
-def main():
+def insight_cache_key(conversation_text):
+    """
+    Hashes the exact LLM input, so the key changes whenever the prompt or the
+    conversation text does.
+    """
+    return hashlib.sha256((SYSTEM_PROMPT + "\0" + conversation_text).encode("utf-8")).hexdigest()
+
+def is_up_to_date(insight, cache_key):
+    """
+    True if a stored insight was generated from the same input. Entries saved before
+    input hashes were recorded are trusted as-is.
+    """
+    return insight is not None and insight.get("input_hash", cache_key) == cache_key
+
+def use_cached_insights(existing_insights, conv_id, cache_key, llm_cache):
+    """
+    Fills in conv_id from the LLM cache if its exact input was summarized before
+    (in an earlier run, or for an identical conversation). Returns True on a cache hit.
+    """
+    cached = llm_cache.get(cache_key)
+    if cached is None:
+        return False
+    summary, keywords = cached
+    existing_insights[conv_id] = {"summary": summary, "keywords": keywords, "input_hash": cache_key}
+    print(f"  Reused cached insights for {conv_id}.")
+    return True
+
+def record_insights(existing_insights, conv_id, summary, keywords, cache_key=None, llm_cache=None):
+    """
+    Stores the result for conv_id in existing_insights (and, when it succeeded, in llm_cache
+    under cache_key). Failures are marked so they are not retried.
+    Returns True if new insights were generated.
+    """
+    if summary is not None or keywords is not None: # Even if one is None but the other exists
+        existing_insights[conv_id] = {
+            "summary": summary if summary is not None else "Generation failed or N/A", 
+            "keywords": keywords if keywords is not None else []
+        }
+        if cache_key is not None:
+            existing_insights[conv_id]["input_hash"] = cache_key
+            if llm_cache is not None:
+                llm_cache[cache_key] = (existing_insights[conv_id]["summary"], existing_insights[conv_id]["keywords"])
+        print(f"  Generated insights for {conv_id}.")
+        if summary: print(f"    Summary: '{summary[:70].replace(chr(10), ' ')}...'") # Show a bit of the summary
+        if keywords: print(f"    Keywords: {keywords}")
+        return True
+
+    print(f"  Failed to generate valid insights for {conv_id}. It will be marked to avoid retries in this run.")
+    # Optionally, mark it with an error state in existing_insights if you want to track failures persistently
+    existing_insights[conv_id] = {"summary": "Error: Failed to generate", "keywords": []}
+    if cache_key is not None:
+        existing_insights[conv_id]["input_hash"] = cache_key
+    return False
+
+def save_insights(insights):
+    """
+    Writes the full insights dict to OUTPUT_INSIGHTS_PATH.
+    The file is written to a temporary path and swapped in with os.replace, so an
+    interrupted save never leaves a truncated or corrupt insights file behind.
+    """
+    tmp_path = OUTPUT_INSIGHTS_PATH + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(insights, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        os.replace(tmp_path, OUTPUT_INSIGHTS_PATH)
+        print(f"  -- Successfully saved {len(insights)} total insights to {OUTPUT_INSIGHTS_PATH} --")
+    except Exception as e:
+        print(f"  ERROR saving insights incrementally: {e}")
+
+async def process_conversations(ids_to_process, messages_by_conversation, existing_insights, llm_cache):
+    """
+    Generates insights for every conversation in ids_to_process concurrently.
+    Conversations whose exact LLM input is already in llm_cache are filled in without an API call.
+    At most MAX_CONCURRENT_REQUESTS LLM calls are in flight at any time. Results are
+    written into existing_insights as they complete and flushed to disk every
+    SAVE_EVERY_N_INSIGHTS new insights; the file is only rewritten when it has unsaved changes.
+    Returns the number of new insights generated.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    save_lock = asyncio.Lock()
+    save_tasks = []
+    total = len(ids_to_process)
+    new_insights_generated_this_session = 0
+    unsaved_changes = 0 # Entries added to existing_insights since the last flush
+
+    def flush():
+        nonlocal unsaved_changes
+        unsaved_changes = 0
+        save_tasks.append(asyncio.create_task(save_snapshot(dict(existing_insights))))
+
+    async def save_snapshot(snapshot):
+        # Serialize writes so an older snapshot never overwrites a newer one
+        async with save_lock:
+            await asyncio.to_thread(save_insights, snapshot)
+
+    async def bounded(position, conv_id):
+        nonlocal new_insights_generated_this_session, unsaved_changes
+        # Get the full text for this conversation
+        conversation_text = get_full_conversation_text_for_llm(conv_id, messages_by_conversation)
+        # Conversations without timestamped messages have no text (None); hash them as ""
+        cache_key = insight_cache_key(conversation_text or "")
+
+        if is_up_to_date(existing_insights.get(conv_id), cache_key): # Check against insights loaded at start
+            print(f"({position}/{total}) Skipping already processed conversation ID (found in loaded insights): {conv_id}")
+            return
+
+        if not conversation_text:
+            print(f"  No processable text found for conversation ID: {conv_id}. Marking as processed and skipping.")
+            if conv_id not in existing_insights: # Never replace insights stored from earlier text
+                existing_insights[conv_id] = {"summary": "Error: No processable text", "keywords": []} # Log error
+                unsaved_changes += 1
+            return
+
+        if use_cached_insights(existing_insights, conv_id, cache_key, llm_cache):
+            unsaved_changes += 1
+            return
+
+        # Generate summary and keywords
+        async with semaphore:
+            print(f"({position}/{total}) Processing conversation ID: {conv_id}")
+            summary, keywords = await generate_insights_for_text(conversation_text, conv_id)
+
+        unsaved_changes += 1
+        if record_insights(existing_insights, conv_id, summary, keywords, cache_key, llm_cache):
+            new_insights_generated_this_session += 1
+            # Save incrementally to avoid losing all progress on error or interruption
+            if new_insights_generated_this_session % SAVE_EVERY_N_INSIGHTS == 0:
+                flush()
+
+    tasks = [bounded(i + 1, conv_id) for i, conv_id in enumerate(ids_to_process)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for conv_id, result in zip(ids_to_process, results):
+        if isinstance(result, Exception):
+            print(f"  ERROR (conv_id: {conv_id}): Unexpected failure while processing: {result}")
+
+    # Final save once every in-flight request has finished, skipped if nothing changed since the last flush
+    if unsaved_changes:
+        flush()
+    await asyncio.gather(*save_tasks)
+    return new_insights_generated_this_session
+
+def submit_insights_batch(ids_to_process, messages_by_conversation, existing_insights, llm_cache):
+    """
+    Writes one Chat Completions request per unprocessed conversation to BATCH_INPUT_PATH,
+    uploads it and creates a Batch API job. Conversations found in llm_cache are filled in
+    directly instead. Returns the batch ID, or None if there was nothing to submit.
+    """
+    requests_written = 0
+    with open(BATCH_INPUT_PATH, "wb") as f:
+        for conv_id in ids_to_process:
+            conversation_text = get_full_conversation_text_for_llm(conv_id, messages_by_conversation)
+            # Conversations without timestamped messages have no text (None); hash them as ""
+            cache_key = insight_cache_key(conversation_text or "")
+            if is_up_to_date(existing_insights.get(conv_id), cache_key):
+                print(f"  Skipping already processed conversation ID (found in loaded insights): {conv_id}")
+                continue
+
+            if not conversation_text or not conversation_text.strip():
+                print(f"  No processable text found for conversation ID: {conv_id}. Marking as processed and skipping.")
+                if conv_id not in existing_insights: # Never replace insights stored from earlier text
+                    existing_insights[conv_id] = {"summary": "Error: No processable text", "keywords": []} # Log error
+                continue
+
+            if use_cached_insights(existing_insights, conv_id, cache_key, llm_cache):
+                continue
+
+            f.write(orjson.dumps({
+                "custom_id": str(conv_id),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_insight_request_body(conversation_text)
+            }) + b"\n")
+            requests_written += 1
+
+    if requests_written == 0:
+        print("No new conversations to submit to the Batch API.")
+        return None
+
+    print(f"Wrote {requests_written} requests to {BATCH_INPUT_PATH}. Uploading...")
+    with open(BATCH_INPUT_PATH, "rb") as f:
+        batch_input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata={"description": "conversation insights"}
+    )
+    print(f"Submitted batch {batch.id} (status: {batch.status}).")
+    print(f"  If this script is interrupted, resume with: python batch_process_insights.py --batch-id {batch.id}")
+    return batch.id
+
+def wait_for_batch(batch_id):
+    """Polls the Batch API until batch_id reaches a terminal status, then returns the batch."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        progress = f"{counts.completed}/{counts.total} completed, {counts.failed} failed" if counts else "no progress yet"
+        print(f"  [{datetime.now().strftime('%H:%M:%S')}] Batch {batch_id}: {batch.status} ({progress})")
+        if batch.status not in BATCH_PENDING_STATUSES:
+            return batch
+        time.sleep(BATCH_POLL_INTERVAL_SECONDS)
+
+def batch_cache_keys(batch):
+    """
+    Maps each custom_id of a batch to the cache key of its input. The keys are rebuilt from
+    the batch's own uploaded input file, so this also works when resuming with --batch-id.
+    """
+    cache_keys = {}
+    for line in client.files.content(batch.input_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        request = orjson.loads(line)
+        conversation_text = request["body"]["messages"][-1]["content"]
+        cache_keys[request["custom_id"]] = insight_cache_key(conversation_text)
+    return cache_keys
+
+def collect_batch_results(batch, existing_insights, llm_cache):
+    """
+    Downloads the output (and error) files of a finished batch and merges the parsed
+    insights into existing_insights and llm_cache. Returns the number of new insights generated.
+    """
+    if batch.status != "completed":
+        print(f"Warning: Batch {batch.id} ended with status '{batch.status}'. Collecting any partial results.")
+
+    cache_keys = batch_cache_keys(batch)
+    new_insights_generated = 0
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            conv_id = result.get("custom_id")
+            response = result.get("response") or {}
+            summary, keywords = None, None
+            if result.get("error") or response.get("status_code") != 200:
+                print(f"  ERROR (conv_id: {conv_id}): Batch request failed: {result.get('error') or response.get('body')}")
+            else:
+                content = response["body"]["choices"][0]["message"]["content"]
+                summary, keywords = parse_insights_response(content, conv_id)
+            if record_insights(existing_insights, conv_id, summary, keywords, cache_keys.get(conv_id), llm_cache):
+                new_insights_generated += 1
+    return new_insights_generated
+
+def run_insights_batch(ids_to_process, messages_by_conversation, existing_insights, llm_cache, batch_id=None):
+    """
+    Generates insights through the Batch API: submits a new batch (unless batch_id is given
+    to resume an existing one), waits for it to finish and saves the results.
+    Returns the number of new insights generated.
+    """
+    if batch_id is None:
+        batch_id = submit_insights_batch(ids_to_process, messages_by_conversation, existing_insights, llm_cache)
+        if batch_id is None:
+            save_insights(existing_insights) # Keep anything filled in from the cache
+            return 0
+
+    print(f"Waiting for batch {batch_id} (completion window: {BATCH_COMPLETION_WINDOW}, polling every {BATCH_POLL_INTERVAL_SECONDS}s)...")
+    batch = wait_for_batch(batch_id)
+    new_insights_generated = collect_batch_results(batch, existing_insights, llm_cache)
+    save_insights(existing_insights)
+    return new_insights_generated
+
+def main(interactive=False, batch_id=None):
     print(f"--- Starting Batch Insight Generation ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---")
-    print(f"Using LLM model: {CHAT_MODEL_FOR_SUMMARY}")
+    print(f"Using LLM model: {CHAT_MODEL_FOR_SUMMARY}, {CHAT_MODEL_FOR_LONG_SUMMARY} for conversations of {LONG_CONVERSATION_TOKENS}+ tokens ({'real-time' if interactive else 'Batch API'})")
 
     # Ensure base output directory exists
     if not os.path.exists(BASE_OUTPUT_DIR):
@@ -127,8 +649,8 @@ def main():
 
     # 1. Load all metadata
     try:
-        with open(METADATA_PATH, "r") as f:
-            all_metadata_list = json.load(f)
+        with open(METADATA_PATH, "rb") as f:
+            all_metadata_list = orjson.loads(f.read())
         if not all_metadata_list:
             print(f"ERROR: Metadata file at {METADATA_PATH} is empty or could not be loaded correctly.")
             return
@@ -136,7 +658,7 @@ def main():
     except FileNotFoundError:
         print(f"ERROR: Metadata file not found at {METADATA_PATH}. Please run `embed_and_index.py` first.")
         return
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print(f"ERROR: Could not decode JSON from {METADATA_PATH}. The file might be corrupt.")
         return
 
@@ -144,20 +666,27 @@ def main():
     existing_insights = {}
     if os.path.exists(OUTPUT_INSIGHTS_PATH):
         try:
-            with open(OUTPUT_INSIGHTS_PATH, "r") as f:
-                existing_insights = json.load(f)
+            with open(OUTPUT_INSIGHTS_PATH, "rb") as f:
+                existing_insights = orjson.loads(f.read())
             print(f"Loaded {len(existing_insights)} existing pre-calculated insights from {OUTPUT_INSIGHTS_PATH}.")
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             print(f"Warning: Could not parse existing insights file at {OUTPUT_INSIGHTS_PATH}. It might be recreated if new insights are generated.")
             existing_insights = {} # Start fresh if corrupt
     
+    if batch_id:
+        # Resume a previously submitted batch; conversation selection already happened at submit time
+        with shelve.open(LLM_CACHE_PATH) as llm_cache:
+            new_insights_generated_this_session = run_insights_batch([], {}, existing_insights, llm_cache, batch_id)
+        print(f"\n--- Batch Processing Session Finished ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---")
+        print(f"Generated new insights for {new_insights_generated_this_session} conversations in this session.")
+        print(f"Total insights now stored in {OUTPUT_INSIGHTS_PATH}: {len(existing_insights)}")
+        return
+
     processed_conv_ids_in_this_run = set(existing_insights.keys())
     
-    # 3. Get unique conversation IDs from the metadata
-    # Ensure conversation_id is not None before adding to the set
-    unique_conversation_ids_all = sorted(list(set(
-        msg.get("conversation_id") for msg in all_metadata_list if msg.get("conversation_id") is not None
-    )))
+    # 3. Group messages by conversation ID (one pass) and get the unique conversation IDs
+    messages_by_conversation = group_messages_by_conversation(all_metadata_list)
+    unique_conversation_ids_all = sorted(messages_by_conversation.keys())
     
     if not unique_conversation_ids_all:
         print("ERROR: No valid 'conversation_id' found in any metadata records. Cannot proceed.")
@@ -188,63 +717,31 @@ def main():
         print("No conversation IDs selected for processing (possibly all processed in test mode). Exiting.")
         return
 
-    print(f"Will attempt to process insights for {len(ids_to_process)} conversation IDs.")
-    new_insights_generated_this_session = 0
-    
-    for i, conv_id in enumerate(ids_to_process):
-        if conv_id in existing_insights: # Check against insights loaded at start
-            print(f"({i+1}/{len(ids_to_process)}) Skipping already processed conversation ID (found in loaded insights): {conv_id}")
-            continue
-
-        print(f"({i+1}/{len(ids_to_process)}) Processing conversation ID: {conv_id}")
-        
-        # Get the full text for this conversation
-        conversation_text = get_full_conversation_text_for_llm(conv_id, all_metadata_list)
-
-        if not conversation_text:
-            print(f"  No processable text found for conversation ID: {conv_id}. Marking as processed and skipping.")
-            existing_insights[conv_id] = {"summary": "Error: No processable text", "keywords": []} # Log error
-            continue # Move to next conversation ID
-
-        # Generate summary and keywords
-        summary, keywords = generate_insights_for_text(conversation_text, conv_id)
-
-        if summary is not None or keywords is not None: # Even if one is None but the other exists
-            existing_insights[conv_id] = {
-                "summary": summary if summary is not None else "Generation failed or N/A", 
-                "keywords": keywords if keywords is not None else []
-            }
-            new_insights_generated_this_session += 1
-            print(f"  Generated insights for {conv_id}.")
-            if summary: print(f"    Summary: '{summary[:70].replace(chr(10), ' ')}...'") # Show a bit of the summary
-            if keywords: print(f"    Keywords: {keywords}")
+    # Results are also cached by a hash of the exact LLM input, so reruns never pay twice for
+    # the same text and conversations whose text changed since the last run are regenerated
+    with shelve.open(LLM_CACHE_PATH) as llm_cache:
+        if interactive:
+            print(f"Will attempt to process insights for {len(ids_to_process)} conversation IDs ({MAX_CONCURRENT_REQUESTS} concurrent requests).")
+            new_insights_generated_this_session = asyncio.run(
+                process_conversations(ids_to_process, messages_by_conversation, existing_insights, llm_cache)
+            )
         else:
-            print(f"  Failed to generate valid insights for {conv_id}. It will be marked to avoid retries in this run.")
-            # Optionally, mark it with an error state in existing_insights if you want to track failures persistently
-            existing_insights[conv_id] = {"summary": "Error: Failed to generate", "keywords": []}
-
-
-        # Save incrementally to avoid losing all progress on error or interruption
-        # Save every 5 processed conversations in this session or at the very end
-        if new_insights_generated_this_session > 0 and (new_insights_generated_this_session % 5 == 0 or i == len(ids_to_process) - 1):
-            try:
-                with open(OUTPUT_INSIGHTS_PATH, "w") as f:
-                    json.dump(existing_insights, f, indent=2)
-                print(f"  -- Successfully saved {len(existing_insights)} total insights to {OUTPUT_INSIGHTS_PATH} --")
-            except Exception as e:
-                print(f"  ERROR saving insights incrementally: {e}")
-        
-        # OpenAI API rate limiting: be respectful. Adjust sleep time as needed.
-        # For gpt-3.5-turbo, 1 second is usually fine. For gpt-4, you might need more.
-        time.sleep(1.1) # Slightly more than 1s to be safe with potential bursts
+            print(f"Will attempt to process insights for {len(ids_to_process)} conversation IDs via the Batch API.")
+            new_insights_generated_this_session = run_insights_batch(ids_to_process, messages_by_conversation, existing_insights, llm_cache)
 
     print(f"\n--- Batch Processing Session Finished ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---")
     print(f"Generated new insights for {new_insights_generated_this_session} conversations in this session.")
     print(f"Total insights now stored in {OUTPUT_INSIGHTS_PATH}: {len(existing_insights)}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-calculate conversation summaries and keywords.")
+    parser.add_argument("--interactive", action="store_true",
+                        help="Use real-time Chat Completions instead of the Batch API (handy for small test runs).")
+    parser.add_argument("--batch-id", help="Resume waiting on a previously submitted batch and collect its results.")
+    args = parser.parse_args()
+
     # Ensure the flattened_output directory exists before trying to write to it
     if not os.path.exists(BASE_OUTPUT_DIR):
         os.makedirs(BASE_OUTPUT_DIR)
         print(f"Created directory: {BASE_OUTPUT_DIR}")
-    main()
+    main(interactive=args.interactive, batch_id=args.batch_id)
@@ -1,37 +1,47 @@
-import json
-import os
-from datetime import datetime
-from tqdm import tqdm
+import orjson
+import pandas as pd
+from dateutil.tz import tzlocal
 
 # Load metadata
 METADATA_PATH = "flattened_output/zain_metadata.json"
 THREAD_INDEX_PATH = "flattened_output/thread_index.json"
 
-with open(METADATA_PATH, "r") as f:
-    records = json.load(f)
-
-# Index by date
-threads_by_date = {}
-
-for r in records:
-    ts = r.get("timestamp") or r.get("create_time") or ""
-    try:
-        dt = datetime.fromisoformat(ts)
-        date_str = dt.strftime("%Y-%m-%d")
-    except:
-        date_str = "unknown"
-
-    if date_str not in threads_by_date:
-        threads_by_date[date_str] = []
-
-    threads_by_date[date_str].append({
-        "role": r["role"],
-        "content": r["content"]
-    })
-
-# Save the thread index
-with open(THREAD_INDEX_PATH, "w") as f:
-    json.dump(threads_by_date, f, indent=2)
-
-print(f"✅ Indexed {len(records)} messages into {len(threads_by_date)} days.")
-
+def message_dates(df):
+    """
+    Returns each message's "YYYY-MM-DD" date, or "unknown", parsing every timestamp in
+    vectorized passes. Timestamps are either Unix seconds, dated in local time like the
+    apps' datetime.fromtimestamp, or ISO 8601 strings, which may differ in shape (with or
+    without microseconds, a UTC offset or a time) and are dated as written.
+    """
+    present = df["timestamp"].notna() & (df["timestamp"] != "") & (df["timestamp"] != 0)
+    ts = df["timestamp"].where(present, df["create_time"])
+    unix_seconds = pd.to_numeric(ts, errors="coerce")
+    unix_dates = pd.to_datetime(unix_seconds, unit="s", errors="coerce", utc=True).dt.tz_convert(tzlocal()).dt.strftime("%Y-%m-%d")
+
+    # format="ISO8601" parses each string on its own; without it pandas infers one format
+    # from the first string and turns differently shaped ones into NaT. The full parse only
+    # validates the string; the date is taken from its date part, so an offset never moves it.
+    iso = ts.where(unix_seconds.isna()).astype("string")
+    valid = pd.to_datetime(iso, format="ISO8601", errors="coerce", utc=True).notna()
+    written = pd.to_datetime(iso.str.split(r"[T ]", n=1, regex=True).str[0], format="ISO8601", errors="coerce")
+    iso_dates = written.where(valid).dt.strftime("%Y-%m-%d")
+    return unix_dates.fillna(iso_dates).fillna("unknown")
+
+if __name__ == "__main__":
+    with open(METADATA_PATH, "rb") as f:
+        records = orjson.loads(f.read())
+
+    # Index by date, then group
+    df = pd.DataFrame(records, columns=["role", "content", "timestamp", "create_time"])
+    df["date"] = message_dates(df)
+
+    threads_by_date = {
+        date_str: group[["role", "content"]].to_dict("records")
+        for date_str, group in df.groupby("date", sort=False)
+    }
+
+    # Save the thread index
+    with open(THREAD_INDEX_PATH, "wb") as f:
+        f.write(orjson.dumps(threads_by_date, option=orjson.OPT_INDENT_2))
+
+    print(f"✅ Indexed {len(records)} messages into {len(threads_by_date)} days.")
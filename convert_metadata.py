@@ -0,0 +1,48 @@
+import math
+import os
+import orjson
+import pyarrow as pa
+
+# Paths
+METADATA_PATH = "flattened_output/zain_metadata.json"
+METADATA_ARROW_PATH = "flattened_output/zain_metadata.arrow"
+
+def to_unix_seconds(value):
+    """Returns a timestamp as float Unix seconds, or None if it is missing, zero, non-finite or unparseable."""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    # NaN is truthy, so it has to be ruled out explicitly (fromtimestamp rejects it)
+    return seconds if seconds and math.isfinite(seconds) else None
+
+def to_optional_str(value):
+    return None if value is None else str(value)
+
+def build_metadata_table(records):
+    """
+    Builds the columnar metadata table (row i still lines up with FAISS id i).
+    role and conversation_id are dictionary-encoded, timestamps are float64 Unix seconds.
+    """
+    return pa.table({
+        "role": pa.array([r.get("role") for r in records], pa.string()).dictionary_encode(),
+        "content": pa.array([r.get("content") for r in records], pa.large_string()),
+        "conversation_id": pa.array([to_optional_str(r.get("conversation_id")) for r in records], pa.string()).dictionary_encode(),
+        "message_id": pa.array([to_optional_str(r.get("message_id")) for r in records], pa.string()),
+        "timestamp": pa.array([to_unix_seconds(r.get("timestamp")) for r in records], pa.float64()),
+    })
+
+if __name__ == "__main__":
+    with open(METADATA_PATH, "rb") as f:
+        records = orjson.loads(f.read())
+
+    # Uncompressed Arrow IPC, so the apps can memory-map it and read columns without copying
+    table = build_metadata_table(records)
+    # Written beside the target and renamed over it, so an app that has the old file
+    # mapped keeps reading a consistent copy
+    with pa.OSFile(METADATA_ARROW_PATH + ".tmp", "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(METADATA_ARROW_PATH + ".tmp", METADATA_ARROW_PATH)
+
+    print(f"✅ Wrote {table.num_rows} metadata rows to {METADATA_ARROW_PATH}")
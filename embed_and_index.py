@@ -1,71 +1,221 @@
 import os
-import json
+import re
+import hashlib
+import asyncio
 import faiss
 import numpy as np
+import orjson
 from dotenv import load_dotenv
-from openai import OpenAI
-from tiktoken import get_encoding
+from openai import AsyncOpenAI, BadRequestError
 
 # Load environment
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+aclient = AsyncOpenAI(api_key=api_key, max_retries=5)
 
 # Constants
 EMBED_MODEL = "text-embedding-3-small"
-MAX_TOKENS = 8192
 DATA_PATH = "flattened_output/conversations.jsonl"
 INDEX_PATH = "flattened_output/zain_index.faiss"
 METADATA_PATH = "flattened_output/zain_metadata.json"
+BATCH_SIZE = 2048              # Max inputs per embeddings request
+MAX_BATCH_TOKENS = 300_000     # Max total tokens per embeddings request
+MAX_CONCURRENT_REQUESTS = 20  # Embedding batches kept in flight at once
 
-# Load tokenizer
-enc = get_encoding("cl100k_base")
+# FAISS index settings (vectors are L2-normalized, so inner product == cosine similarity)
+HNSW_M = 32                      # Graph neighbours per node
+HNSW_EF_CONSTRUCTION = 200       # Build-time search depth (higher = better graph)
+HNSW_STORAGE = faiss.ScalarQuantizer.QT_8bit  # Stored vector precision: a quarter of the bytes of float32
+IVFPQ_MIN_VECTORS = 1_000_000    # From this size on, switch to compressed IVF+PQ
+IVFPQ_M = 64                     # PQ sub-quantizers (must divide the embedding dim)
+IVFPQ_NBITS = 8                  # Bits per PQ code
+IVF_NPROBE = 16                  # Inverted lists visited per query
 
-# Load records
-with open(DATA_PATH, "r") as f:
-    records = [json.loads(line) for line in f if line.strip()]
+# Stream records so only the ones that survive sanitizing stay in memory
+def iter_records(path):
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
 
-# Sanitize + filter
-texts = []
-valid_records = []
-for r in records:
+def filter_record(r):
+    """Returns the record's stripped content, or None if it is not worth embedding."""
     content = r.get("content", "")
     if not isinstance(content, str):
-        continue
+        return None
     stripped = content.strip()
     if not stripped or stripped in {"{}", "[]"} or len(stripped) < 3:
+        return None
+    return stripped
+
+# Sanitize + filter, grouping records into embeddings requests as we go.
+# This stays in-process: it is a few string ops per record, cheaper than
+# pickling the record to a worker would be. There is no token-count preflight:
+# inputs over the model's 8192-token limit are rare in chat data and are
+# dropped when the API rejects them (see embed_inputs).
+# Repeated messages (greetings, acknowledgements, boilerplate) are embedded
+# once: texts holds each distinct text, text_ids maps every record to its text.
+texts = []
+valid_records = []
+text_ids = []
+seen = {}  # content digest -> position in texts
+batch_spans = []  # (start, end) slices of texts, one per embeddings request
+batch_start = 0
+batch_tokens = 0
+for r in iter_records(DATA_PATH):
+    stripped = filter_record(r)
+    if stripped is None:
         continue
-    token_len = len(enc.encode(stripped))
-    if token_len < MAX_TOKENS:
-        texts.append(stripped)
-        valid_records.append(r)
-
-print(f"🧠 {len(valid_records)} records ready for embedding")
-
-# Embed in batches
-embeddings = []
-BATCH_SIZE = 100
-for i in range(0, len(texts), BATCH_SIZE):
-    batch = texts[i:i+BATCH_SIZE]
-    try:
-        res = client.embeddings.create(model=EMBED_MODEL, input=batch)
-        batch_embeds = [e.embedding for e in res.data]
-        embeddings.extend(batch_embeds)
-        print(f"  → Embedded batch {i // BATCH_SIZE + 1}")
-    except Exception as e:
-        print(f"❌ Batch {i // BATCH_SIZE + 1} failed: {e}")
+    valid_records.append(r)
+    encoded = stripped.encode("utf-8")
+    digest = hashlib.blake2b(encoded, digest_size=16).digest()
+    if digest in seen:
+        text_ids.append(seen[digest])
         continue
+    seen[digest] = len(texts)
+    text_ids.append(len(texts))
+    # Every BPE token covers at least one UTF-8 byte, so the byte length is an
+    # upper bound on the token count
+    n_tokens = len(encoded)
+    if len(texts) > batch_start and (
+        len(texts) - batch_start >= BATCH_SIZE or batch_tokens + n_tokens > MAX_BATCH_TOKENS
+    ):
+        batch_spans.append((batch_start, len(texts)))
+        batch_start, batch_tokens = len(texts), 0
+    texts.append(stripped)
+    batch_tokens += n_tokens
+if len(texts) > batch_start:
+    batch_spans.append((batch_start, len(texts)))
+
+text_ids = np.asarray(text_ids, dtype=np.int64)
+print(f"🧠 {len(valid_records)} records ready for embedding ({len(texts)} unique texts in {len(batch_spans)} batches)")
+
+def is_input_rejection(e):
+    """True if a 400 is about an input itself (e.g. too many tokens), not the whole request."""
+    message = str(e)
+    return (
+        getattr(e, "code", None) == "context_length_exceeded"
+        or "maximum context length" in message
+        or re.search(r"input\[\d+\]", message) is not None
+    )
+
+# Embed in batches, several requests in flight at once
+async def embed_inputs(batch, semaphore):
+    """Embeds batch, returning None in place of any input the API rejects (e.g. too many tokens)."""
+    try:
+        async with semaphore:
+            res = await aclient.embeddings.create(model=EMBED_MODEL, input=batch)
+        return [e.embedding for e in res.data]
+    except BadRequestError as e:
+        # Request-level errors (bad model name, malformed request) fail every input alike:
+        # re-raise so the batch is reported as failed instead of bisected down to single calls
+        if not is_input_rejection(e):
+            raise
+        if len(batch) == 1:
+            print(f"  ⚠️ Skipping input rejected by the API: {e}")
+            return [None]
+        # The error usually names the offending input ("input[12]"): drop it and retry
+        match = re.search(r"input\[(\d+)\]", str(e))
+        if match and int(match.group(1)) < len(batch):
+            bad = int(match.group(1))
+            print(f"  ⚠️ Skipping input rejected by the API: {e}")
+            rest = await embed_inputs(batch[:bad] + batch[bad+1:], semaphore)
+            return rest[:bad] + [None] + rest[bad:]
+        # Otherwise split the batch and retry each half
+        mid = len(batch) // 2
+        return await embed_inputs(batch[:mid], semaphore) + await embed_inputs(batch[mid:], semaphore)
+
+async def embed_batch(batch_no, batch, semaphore):
+    batch_embeds = await embed_inputs(batch, semaphore)
+    print(f"  → Embedded batch {batch_no}")
+    return batch_embeds
+
+async def embed_all(texts, batch_spans):
+    """Embeds texts straight into a preallocated float32 matrix.
+
+    Returns (xb, embedded) where embedded flags the rows that were filled;
+    xb is None if no batch succeeded.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    pending = list(enumerate(batch_spans, start=1))
+    embedded = np.zeros(len(texts), dtype=bool)
+    xb = None
+
+    def store(start, end, batch_embeds):
+        kept = [i for i, emb in enumerate(batch_embeds) if emb is not None]
+        if len(kept) == end - start:
+            xb[start:end] = np.asarray(batch_embeds, dtype=np.float32)
+            embedded[start:end] = True
+        elif kept:
+            rows = start + np.asarray(kept)
+            xb[rows] = np.asarray([batch_embeds[i] for i in kept], dtype=np.float32)
+            embedded[rows] = True
+
+    # Embed one batch on its own first to learn the embedding dimension,
+    # then allocate the output matrix and run the rest concurrently
+    while pending and xb is None:
+        batch_no, (start, end) = pending.pop(0)
+        try:
+            batch_embeds = await embed_batch(batch_no, texts[start:end], semaphore)
+        except Exception as e:
+            print(f"❌ Batch {batch_no} failed: {e}")
+            continue
+        first = next((emb for emb in batch_embeds if emb is not None), None)
+        if first is None:
+            continue
+        xb = np.empty((len(texts), len(first)), dtype=np.float32)
+        store(start, end, batch_embeds)
+
+    async def embed_into(batch_no, start, end):
+        try:
+            store(start, end, await embed_batch(batch_no, texts[start:end], semaphore))
+        except Exception as e:
+            print(f"❌ Batch {batch_no} failed: {e}")
+
+    await asyncio.gather(*(embed_into(batch_no, start, end) for batch_no, (start, end) in pending))
+    return xb, embedded
+
+xb, embedded = asyncio.run(embed_all(texts, batch_spans))
+
+# Build an approximate nearest-neighbour index: HNSW for typical exports,
+# IVF+PQ once the collection is large enough for memory to matter
+def build_index(xb):
+    n, dim = xb.shape
+    if n < IVFPQ_MIN_VECTORS:
+        # 8-bit storage (per-dimension min/max learned by train) cuts the memory each
+        # distance computation streams through to a quarter; the precision loss is far
+        # below the spread of cosine scores and HNSW's efSearch absorbs the reranking noise
+        index = faiss.IndexHNSWSQ(dim, HNSW_STORAGE, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.train(xb)
+    else:
+        nlist = int(4 * np.sqrt(n))
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, IVFPQ_M, IVFPQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+        index.train(xb)
+        index.nprobe = IVF_NPROBE
+    index.add(xb)
+    return index
 
 # Save FAISS index
-if embeddings:
-    dim = len(embeddings[0])
-    index = faiss.IndexFlatL2(dim)
-    index.add(np.array(embeddings).astype("float32"))
-    faiss.write_index(index, INDEX_PATH)
+if xb is not None:
+    # Give each record its text's embedding, dropping records whose text failed
+    # or was rejected so metadata rows stay aligned with FAISS ids
+    ok = embedded[text_ids]
+    xb = xb[text_ids[ok]]
+    embedded_records = [r for r, keep in zip(valid_records, ok) if keep]
+    faiss.normalize_L2(xb)
+    index = build_index(xb)
+    # Write to a temp file and rename over the old one: apps memory-map the index,
+    # and rewriting the mapped file in place would change pages under a live reader.
+    # The rename leaves readers on the old inode until they reload.
+    faiss.write_index(index, INDEX_PATH + ".tmp")
+    os.replace(INDEX_PATH + ".tmp", INDEX_PATH)
     print(f"✅ FAISS index saved: {INDEX_PATH}")
 
-    with open(METADATA_PATH, "w") as f:
-        json.dump(valid_records, f)
+    with open(METADATA_PATH + ".tmp", "wb") as f:
+        f.write(orjson.dumps(embedded_records))
+    os.replace(METADATA_PATH + ".tmp", METADATA_PATH)
     print(f"✅ Metadata saved: {METADATA_PATH}")
 else:
     print("⛔ No embeddings created. Check previous batch errors.")
@@ -1,20 +1,18 @@
 import streamlit as st
-import json
 import faiss
 import numpy as np
+import orjson
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
 from datetime import datetime
+from dateutil.tz import tzlocal
 import re
+import time
 import pandas as pd
-import plotly.graph_objects as go
-import plotly.express as px
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
-import networkx as nx
-from collections import defaultdict
-import uuid
+from collections import Counter, defaultdict
+import heapq
+import math
 
 # --- Configuration and Setup ---
 st.set_page_config(
@@ -77,68 +75,210 @@ st.markdown("""
 # Load environment variables
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
+API_KEY_VALID = bool(api_key) and api_key != "your_api_key_here"
+
+@st.cache_resource
+def get_openai_client():
+    """
+    Builds the OpenAI client once per server process. Streamlit re-executes this script
+    on every interaction, so an uncached client would open a fresh connection pool each time.
+    """
+    return OpenAI(api_key=api_key) if API_KEY_VALID else None
+
+client = get_openai_client()
 
 # Constants
 METADATA_PATH = "flattened_output/zain_metadata.json"
 INDEX_PATH = "flattened_output/zain_index.faiss"
-NOTES_PATH = "flattened_output/conversation_notes.json"
+NOTES_PATH = "flattened_output/conversation_notes.jsonl"  # Append-only log of note edits
+LEGACY_NOTES_PATH = "flattened_output/conversation_notes.json"  # Older single-dict format, imported once
 EMBED_MODEL = "text-embedding-3-small"
+EMBED_RETRY_AFTER_SECONDS = 60  # A request that just failed is not retried before this
+EMBED_CACHE_ENTRIES = 1024  # Query embeddings kept in the disk-persisted cache (about 6 KB each)
+# Search-time recall/speed knobs for the ANN index built by embed_and_index.py
+HNSW_EF_SEARCH = 64  # Candidates explored per HNSW query
+IVF_NPROBE = 16  # Inverted lists visited per IVF query
+# OpenMP threads for FAISS search. Defaults to the CPUs this process may run on,
+# which inside a container can be far fewer than the host's os.cpu_count().
+FAISS_THREADS = int(os.getenv("FAISS_THREADS", len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1))
+# Index read flags: memory-mapped and read-only. IO_FLAG_MMAP alone only maps IVF lists;
+# IO_FLAG_MMAP_IFC (FAISS 1.11+) also maps flat/SQ code storage, e.g. the HNSW index's vectors.
+INDEX_READ_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+# Mind map topics: k-means over PCA-reduced message embeddings
+CLUSTER_COUNT = 8  # Topics to find
+CLUSTER_PCA_DIM = 50  # Dimensions kept before clustering
+CLUSTER_SAMPLE_SIZE = 50_000  # Vectors used to fit PCA and k-means
+CLUSTER_CHUNK_SIZE = 10_000  # Vectors decoded at a time when assigning every message
+CLUSTER_STOPWORDS = {
+    'about', 'also', 'been', 'could', 'does', 'each', 'from', 'have', 'here', 'into', 'just',
+    'like', 'make', 'more', 'need', 'only', 'other', 'should', 'some', 'than', 'that', 'their',
+    'them', 'then', 'there', 'these', 'they', 'this', 'those', 'want', 'were', 'what', 'when',
+    'which', 'will', 'with', 'would', 'your'
+}
 
 # --- Helper Functions ---
 @st.cache_resource
 def load_metadata():
     try:
-        with open(METADATA_PATH, "r") as f:
-            metadata_list = json.load(f)
-        for record in metadata_list:
-            if record.get("timestamp"):
-                try:
-                    record["datetime_obj"] = datetime.fromtimestamp(float(record["timestamp"]))
-                except (ValueError, TypeError):
-                    record["datetime_obj"] = None
-        return metadata_list
+        with open(METADATA_PATH, "rb") as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         st.error(f"Metadata file not found: {METADATA_PATH}")
         return []
 
+@st.cache_resource
+def group_by_conversation(_metadata_list):
+    """Builds a {conversation_id: [records]} index once, so opening a conversation is a dict lookup."""
+    conv_index = defaultdict(list)
+    for record in _metadata_list:
+        conv_index[record.get('conversation_id')].append(record)
+    return dict(conv_index)
+
+@st.cache_resource
+def build_metadata_frame(_metadata_list):
+    """
+    Materializes the columns analytics needs into a DataFrame once: role as a category
+    and the timestamp as naive local-time datetime64, so charts are C-level groupbys.
+    Local time (DST-aware, like datetime.fromtimestamp in get_record_datetime) keeps a
+    message on the same day in Analytics as in the Search cards and date filter.
+    """
+    df = pd.DataFrame(_metadata_list, columns=['role', 'timestamp'])
+    df['role'] = df['role'].fillna('unknown').astype('category')
+    seconds = pd.to_numeric(df['timestamp'], errors='coerce')
+    seconds = seconds.where(seconds != 0) # A zero timestamp means missing, as in get_record_datetime
+    df['datetime_obj'] = pd.to_datetime(seconds, unit='s', errors='coerce', utc=True).dt.tz_convert(tzlocal()).dt.tz_localize(None)
+    return df
+
+def get_record_preview(record, length):
+    """Returns the record's content cut to length characters (with an ellipsis if cut), cached on the record."""
+    key = f"preview_{length}"
+    if key not in record:
+        content = record.get('content', '')
+        record[key] = content if len(content) <= length else f"{content[:length]}…"
+    return record[key]
+
+def get_record_datetime(record):
+    """Parses a record's timestamp on first use and caches it in record["datetime_obj"]."""
+    if "datetime_obj" not in record:
+        try:
+            record["datetime_obj"] = datetime.fromtimestamp(float(record["timestamp"])) if record.get("timestamp") else None
+        except (ValueError, TypeError):
+            record["datetime_obj"] = None
+    return record["datetime_obj"]
+
 @st.cache_resource
 def load_faiss_index():
+    """Memory-maps the index read-only; vectors are paged in on demand instead of loaded up front."""
+    faiss.omp_set_num_threads(FAISS_THREADS)
     try:
-        return faiss.read_index(INDEX_PATH)
+        index = faiss.read_index(INDEX_PATH, INDEX_READ_FLAGS)
     except Exception as e:
         st.error(f"FAISS index not found: {INDEX_PATH}")
         return None
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif hasattr(index, "nprobe"):
+        index.nprobe = IVF_NPROBE
+    # Search on the GPU when FAISS has GPU support and one is present; index types
+    # without a GPU implementation (e.g. HNSW) stay on the CPU
+    if faiss.get_num_gpus() > 0:
+        try:
+            index = faiss.index_cpu_to_gpu(load_gpu_resources(), 0, index)
+        except Exception:
+            pass
+    return index
+
+@st.cache_resource
+def load_gpu_resources():
+    """FAISS GPU scratch memory, allocated once per server process."""
+    return faiss.StandardGpuResources()
 
 def load_notes():
-    try:
-        with open(NOTES_PATH, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+    """
+    Replays the notes log into a {conv_id: note} dict; later lines override earlier
+    ones and a None note deletes. The log is compacted once it is over twice as
+    long as the notes it holds.
+    """
+    if not os.path.exists(NOTES_PATH):
+        try:
+            with open(LEGACY_NOTES_PATH, "rb") as f:
+                notes = orjson.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        write_notes(notes)
+        return notes
 
-def save_notes(notes):
-    with open(NOTES_PATH, "w") as f:
-        json.dump(notes, f, indent=2)
+    notes = {}
+    entries = 0
+    with open(NOTES_PATH, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = orjson.loads(line)
+            entries += 1
+            if entry["note"] is None:
+                notes.pop(entry["conv_id"], None)
+            else:
+                notes[entry["conv_id"]] = entry["note"]
+    if entries > 2 * len(notes):
+        write_notes(notes)
+    return notes
 
-def get_embedding(text, model=EMBED_MODEL):
-    if not api_key or api_key == "your_api_key_here":
-        st.warning("Please set a valid OpenAI API key in .env file")
+def write_notes(notes):
+    """Rewrites the notes log with one line per note, swapped in atomically."""
+    tmp_path = NOTES_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for conv_id, note in notes.items():
+            f.write(orjson.dumps({"conv_id": conv_id, "note": note, "ts": time.time()}) + b"\n")
+    os.replace(tmp_path, NOTES_PATH)
+
+def save_note(conv_id, note):
+    """Appends a single note edit to the log (note=None deletes the note)."""
+    with open(NOTES_PATH, "ab") as f:
+        f.write(orjson.dumps({"conv_id": conv_id, "note": note, "ts": time.time()}) + b"\n")
+
+@st.cache_data(max_entries=EMBED_CACHE_ENTRIES, persist="disk", show_spinner=False)
+def embed_texts(texts, model):
+    """
+    Embeds a tuple of texts in one request. Rows are unit-normalized to match the index,
+    so inner-product search scores are cosine similarities. Cached on disk, so repeat
+    queries skip the API.
+    """
+    response = client.embeddings.create(input=list(texts), model=model)
+    vectors = np.array([item.embedding for item in response.data], dtype="float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+@st.cache_resource
+def load_embedding_failures():
+    """Shared {(texts, model): failure time} record, so reruns don't immediately repeat a doomed request."""
+    return {}
+
+def get_embedding(texts, model=EMBED_MODEL):
+    """Returns an (n, d) float32 array with one row per text, or None on failure."""
+    if not API_KEY_VALID:
+        return None
+    request_key = (tuple(texts), model)
+    failures = load_embedding_failures()
+    if time.time() - failures.get(request_key, 0) < EMBED_RETRY_AFTER_SECONDS:
         return None
     try:
-        client = OpenAI(api_key=api_key)
-        response = client.embeddings.create(input=[text], model=model)
-        return np.array(response.data[0].embedding).astype("float32")
+        return embed_texts(request_key[0], model)
     except Exception as e:
+        now = time.time()
+        for key in [key for key, failed_at in failures.items() if now - failed_at >= EMBED_RETRY_AFTER_SECONDS]:
+            del failures[key]
+        failures[request_key] = now
         st.error(f"Error getting embedding: {e}")
         return None
 
-def cluster_conversations(metadata_list, n_clusters=5):
-    """Create topic clusters for mind map visualization"""
-    if not metadata_list:
+@st.cache_resource
+def cluster_conversations(_metadata_list, n_clusters=5):
+    """Create topic clusters for mind map visualization (computed once per metadata load)"""
+    if not _metadata_list:
         return [], []
     
     # Create simple topic clusters based on keywords
-    topics = defaultdict(list)
     keywords_map = {
         'search': ['search', 'query', 'find', 'semantic'],
         'ai': ['ai', 'openai', 'model', 'assistant'],
@@ -147,68 +287,115 @@ def cluster_conversations(metadata_list, n_clusters=5):
         'notes': ['note', 'annotation', 'comment', 'tag']
     }
     
-    for i, record in enumerate(metadata_list):
-        content = record.get('content', '').lower()
-        assigned = False
-        for topic, keywords in keywords_map.items():
-            if any(keyword in content for keyword in keywords):
-                topics[topic].append(i)
-                assigned = True
-                break
-        if not assigned:
-            topics['general'].append(i)
+    # One compiled alternation per topic, matched against every message at once:
+    # hits[i, t] is True when message i mentions topic t
+    contents = pd.Series([record.get('content', '') for record in _metadata_list], dtype=object)
+    hits = np.column_stack([
+        contents.str.contains(re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE), na=False).to_numpy()
+        for keywords in keywords_map.values()
+    ])
+    
+    # Topics are tried in order and the first match wins; messages matching none go to 'general'
+    topic_names = list(keywords_map) + ['general']
+    topic_ids = np.where(hits.any(axis=1), hits.argmax(axis=1), len(keywords_map))
+    topics = {}
+    for t, topic in enumerate(topic_names):
+        indices = np.flatnonzero(topic_ids == t)
+        if indices.size:
+            topics[topic] = indices.tolist()
     
     return topics, keywords_map
 
-def create_mind_map(topics, metadata_list):
-    """Create a network graph for mind map visualization"""
-    fig = go.Figure()
+@st.cache_resource
+def cluster_from_embeddings(_index, _metadata_list, n_clusters=CLUSTER_COUNT):
+    """
+    Groups messages by meaning: k-means on PCA-reduced embeddings read back from the index,
+    each cluster labelled by its most distinctive words. Returns (topics, keywords_map) like
+    cluster_conversations, or None if the index can't return its vectors.
+    """
+    n = _index.ntotal
+    if n < n_clusters or n != len(_metadata_list):
+        return None
     
-    # Create network graph
-    G = nx.Graph()
+    # Fit PCA and k-means on a sample, then assign every message chunk by chunk
+    sample_ids = np.sort(np.random.default_rng(0).choice(n, size=min(n, CLUSTER_SAMPLE_SIZE), replace=False))
+    try:
+        sample = _index.reconstruct_batch(sample_ids)
+    except RuntimeError:
+        return None  # e.g. IVF-PQ without a direct map, or a GPU index
+    pca = faiss.PCAMatrix(sample.shape[1], min(CLUSTER_PCA_DIM, sample.shape[1]))
+    pca.train(sample)
+    kmeans = faiss.Kmeans(pca.d_out, n_clusters, niter=20, seed=0)
+    kmeans.train(pca.apply(sample))
+    labels = np.empty(n, dtype=np.int64)
+    for start in range(0, n, CLUSTER_CHUNK_SIZE):
+        count = min(CLUSTER_CHUNK_SIZE, n - start)
+        _, assigned = kmeans.index.search(pca.apply(_index.reconstruct_n(start, count)), 1)
+        labels[start:start + count] = assigned[:, 0]
+    
+    # Label clusters with words frequent in them but rare in the other clusters
+    word_pattern = re.compile(r"[a-z]{4,}")
+    cluster_words = [Counter() for _ in range(n_clusters)]
+    for record, label in zip(_metadata_list, labels):
+        cluster_words[label].update(set(word_pattern.findall(record.get('content', '').lower())) - CLUSTER_STOPWORDS)
+    clusters_with_word = Counter()
+    for words in cluster_words:
+        clusters_with_word.update(words.keys())
     
-    # Add central node
-    G.add_node("Memory Search", type="central")
+    topics = {}
+    keywords_map = {}
+    for c, words in enumerate(cluster_words):
+        indices = np.flatnonzero(labels == c).tolist()
+        if not indices:
+            continue
+        top_terms = heapq.nlargest(4, words, key=lambda w: words[w] * math.log(1 + n_clusters / clusters_with_word[w]))
+        name = " / ".join(top_terms[:2]) or f"cluster {c + 1}"
+        if name in topics:
+            name = f"{name} ({c + 1})"
+        topics[name] = indices
+        keywords_map[name] = top_terms
+    return topics, keywords_map
+
+def create_mind_map(topics, metadata_list):
+    """Create the mind map figure: a star of topics around a central node, with conversations around each topic"""
+    # Plotly is only needed by the chart modes, so it is imported on first use
+    import plotly.express as px
+    import plotly.graph_objects as go
+    
+    fig = go.Figure()
     
-    # Add topic nodes and conversation nodes
     colors = px.colors.qualitative.Set3
-    node_trace = []
-    edge_trace = []
     
-    pos_data = {}
-    pos_data["Memory Search"] = (0, 0)
+    # Topic nodes evenly spaced on a circle around the central node
+    topic_names = list(topics)
+    topic_angles = np.linspace(0, 2 * np.pi, len(topic_names), endpoint=False)
+    topic_x = 3 * np.cos(topic_angles)
+    topic_y = 3 * np.sin(topic_angles)
     
-    # Add topic nodes around center
-    angle_step = 2 * np.pi / len(topics)
-    for i, (topic, conv_indices) in enumerate(topics.items()):
-        angle = i * angle_step
-        x = 3 * np.cos(angle)
-        y = 3 * np.sin(angle)
-        pos_data[topic] = (x, y)
-        G.add_node(topic, type="topic")
-        G.add_edge("Memory Search", topic)
-        
-        # Add conversation nodes around each topic
-        conv_angle_step = 2 * np.pi / max(len(conv_indices), 1)
+    # Conversation nodes around each topic
+    conv_parent = []  # Topic position of each conversation node
+    conv_slot = []  # Angular slot of the conversation around its topic
+    conv_slots_total = []  # Slots around that topic (one per conversation in it)
+    conv_titles = []
+    for i, conv_indices in enumerate(topics.values()):
         for j, conv_idx in enumerate(conv_indices[:5]):  # Limit to 5 conversations per topic
             if conv_idx < len(metadata_list):
-                conv_angle = j * conv_angle_step
-                conv_x = x + 1.5 * np.cos(conv_angle)
-                conv_y = y + 1.5 * np.sin(conv_angle)
-                conv_title = metadata_list[conv_idx].get('content', '')[:30] + "..."
-                node_id = f"conv_{conv_idx}"
-                pos_data[node_id] = (conv_x, conv_y)
-                G.add_node(node_id, type="conversation", title=conv_title)
-                G.add_edge(topic, node_id)
+                conv_parent.append(i)
+                conv_slot.append(j)
+                conv_slots_total.append(max(len(conv_indices), 1))
+                conv_titles.append(get_record_preview(metadata_list[conv_idx], 30))
+    conv_parent = np.asarray(conv_parent, dtype=int)
+    conv_angles = 2 * np.pi * np.asarray(conv_slot, dtype=float) / np.asarray(conv_slots_total, dtype=float)
+    conv_x = topic_x[conv_parent] + 1.5 * np.cos(conv_angles)
+    conv_y = topic_y[conv_parent] + 1.5 * np.sin(conv_angles)
     
-    # Create traces for edges
-    edge_x = []
-    edge_y = []
-    for edge in G.edges():
-        x0, y0 = pos_data[edge[0]]
-        x1, y1 = pos_data[edge[1]]
-        edge_x.extend([x0, x1, None])
-        edge_y.extend([y0, y1, None])
+    # Edges (center -> topic, topic -> conversation) as x0, x1, gap triples; NaN breaks the line
+    edge_start_x = np.concatenate([np.zeros(len(topic_names)), topic_x[conv_parent]])
+    edge_start_y = np.concatenate([np.zeros(len(topic_names)), topic_y[conv_parent]])
+    edge_x = np.full(3 * len(edge_start_x), np.nan)
+    edge_y = np.full(3 * len(edge_start_y), np.nan)
+    edge_x[0::3], edge_x[1::3] = edge_start_x, np.concatenate([topic_x, conv_x])
+    edge_y[0::3], edge_y[1::3] = edge_start_y, np.concatenate([topic_y, conv_y])
     
     # Create edge trace
     fig.add_trace(go.Scatter(
@@ -219,29 +406,12 @@ def create_mind_map(topics, metadata_list):
     ))
     
     # Create node traces for different types
-    for node_type in ["central", "topic", "conversation"]:
-        node_x = []
-        node_y = []
-        node_text = []
-        node_info = []
-        
-        for node in G.nodes():
-            if G.nodes[node].get('type') == node_type:
-                x, y = pos_data[node]
-                node_x.append(x)
-                node_y.append(y)
-                
-                if node_type == "central":
-                    node_text.append("🧠 Memory Search")
-                    node_info.append("Central hub for all conversations")
-                elif node_type == "topic":
-                    node_text.append(f"📂 {node.title()}")
-                    node_info.append(f"Topic: {node}")
-                else:
-                    title = G.nodes[node].get('title', node)
-                    node_text.append(f"💬 {title[:20]}...")
-                    node_info.append(title)
-        
+    node_groups = [
+        ("central", [0.0], [0.0], ["🧠 Memory Search"], ["Central hub for all conversations"]),
+        ("topic", topic_x, topic_y, [f"📂 {topic.title()}" for topic in topic_names], [f"Topic: {topic}" for topic in topic_names]),
+        ("conversation", conv_x, conv_y, [f"💬 {title[:20]}…" for title in conv_titles], conv_titles),
+    ]
+    for node_type, node_x, node_y, node_text, node_info in node_groups:
         size = 30 if node_type == "central" else 20 if node_type == "topic" else 15
         color = colors[0] if node_type == "central" else colors[1] if node_type == "topic" else colors[2]
         
@@ -278,8 +448,86 @@ def create_mind_map(topics, metadata_list):
     
     return fig
 
+def search_memory(query, filter_role, date_filter, max_results):
+    """
+    Returns [(metadata position, score)] for the best matches that pass the filters,
+    or None if the query could not be embedded.
+    """
+    query_vectors = get_embedding([query])
+    if query_vectors is None:
+        return None
+    # Over-fetch when filtering so enough hits survive it
+    filtering = filter_role != "Any" or date_filter is not None
+    D, I = index.search(query_vectors, max_results * 5 if filtering else max_results)
+    results = []
+    for idx, score in zip(I[0], D[0]):
+        if idx < 0 or idx >= len(metadata_list):
+            continue
+        record = metadata_list[idx]
+        if filter_role != "Any" and record.get('role') != filter_role.lower():
+            continue
+        if date_filter is not None:
+            record_dt = get_record_datetime(record)
+            if record_dt is None or record_dt.date() != date_filter:
+                continue
+        results.append((int(idx), float(score)))
+        if len(results) == max_results:
+            break
+    return results
+
+@st.fragment
+def render_search_result(i, record, score):
+    """Renders one result card; its buttons rerun only this card, not the whole page."""
+    with st.container():
+        st.markdown('<div class="conversation-card">', unsafe_allow_html=True)
+
+        col1, col2, col3 = st.columns([6, 2, 2])
+
+        with col1:
+            role_icon = "👤" if record.get('role') == 'user' else "🤖"
+            st.write(f"{role_icon} **{record.get('role', 'unknown').title()}** · Score: {score:.2f}")
+            st.write(get_record_preview(record, 200))
+
+        with col2:
+            record_dt = get_record_datetime(record)
+            if record_dt:
+                st.write("📅", record_dt.strftime('%Y-%m-%d'))
+                st.write("🕐", record_dt.strftime('%H:%M'))
+
+        with col3:
+            conv_id = record.get('conversation_id', f'conv_{i}')
+            if st.button(f"💬 View", key=f"view_{i}"):
+                st.session_state[f'show_conv_{conv_id}'] = True
+
+            if st.button(f"📝 Note", key=f"note_{i}"):
+                st.session_state[f'show_note_{conv_id}'] = True
+
+        # Show full conversation if requested
+        if st.session_state.get(f'show_conv_{conv_id}', False):
+            st.write("**Full Conversation:**")
+            # Show related messages from same conversation
+            conv_messages = conv_index.get(conv_id, [])
+            for msg in conv_messages:
+                role_icon = "👤" if msg.get('role') == 'user' else "🤖"
+                st.write(f"{role_icon} {msg.get('content', '')}")
+
+        # Note input if requested
+        if st.session_state.get(f'show_note_{conv_id}', False):
+            note_text = st.text_area(f"Add note for conversation {conv_id}:", 
+                                   value=notes.get(conv_id, ''), 
+                                   key=f"note_input_{conv_id}")
+            if st.button(f"Save Note", key=f"save_note_{i}"):
+                notes[conv_id] = note_text
+                save_note(conv_id, note_text)
+                st.success("Note saved!")
+                st.session_state[f'show_note_{conv_id}'] = False
+                st.rerun(scope="fragment")
+
+        st.markdown('</div>', unsafe_allow_html=True)
+
 # --- Load Data ---
 metadata_list = load_metadata()
+conv_index = group_by_conversation(metadata_list)
 index = load_faiss_index()
 notes = load_notes()
 
@@ -311,7 +559,7 @@ if mode == "🔍 Search":
     with st.sidebar:
         st.subheader("🔧 Search Filters")
         filter_role = st.selectbox("Role:", ["Any", "User", "Assistant"])
-        date_filter = st.date_input("Filter by date (optional):")
+        date_filter = st.date_input("Filter by date (optional):", value=None)
         max_results = st.slider("Max results:", 1, 20, 10)
     
     if search_query and (search_button or search_query):
@@ -320,57 +568,27 @@ if mode == "🔍 Search":
             st.write(f"🔍 Searching for: **{search_query}**")
             st.markdown('</div>', unsafe_allow_html=True)
             
-            # Perform search (simplified for demo)
-            st.info("Search functionality requires valid OpenAI API key and embedded data.")
+            # Only search again when the query or a filter changed; other reruns
+            # (button clicks, note saves) reuse the last result set
+            search_key = (search_query, filter_role, date_filter, max_results)
+            if st.session_state.get('search_key') != search_key:
+                results = search_memory(*search_key)
+                if results is not None:
+                    st.session_state['search_key'] = search_key
+                    st.session_state['search_results'] = results
+            else:
+                results = st.session_state['search_results']
             
-            # Show sample results for demo
-            st.subheader("📋 Search Results")
-            for i, record in enumerate(metadata_list[:max_results]):
-                with st.container():
-                    st.markdown('<div class="conversation-card">', unsafe_allow_html=True)
-                    
-                    col1, col2, col3 = st.columns([6, 2, 2])
-                    
-                    with col1:
-                        role_icon = "👤" if record.get('role') == 'user' else "🤖"
-                        st.write(f"{role_icon} **{record.get('role', 'unknown').title()}**")
-                        st.write(record.get('content', '')[:200] + "...")
-                    
-                    with col2:
-                        if record.get('datetime_obj'):
-                            st.write("📅", record['datetime_obj'].strftime('%Y-%m-%d'))
-                            st.write("🕐", record['datetime_obj'].strftime('%H:%M'))
-                    
-                    with col3:
-                        conv_id = record.get('conversation_id', f'conv_{i}')
-                        if st.button(f"💬 View", key=f"view_{i}"):
-                            st.session_state[f'show_conv_{conv_id}'] = True
-                        
-                        if st.button(f"📝 Note", key=f"note_{i}"):
-                            st.session_state[f'show_note_{conv_id}'] = True
-                    
-                    # Show full conversation if requested
-                    if st.session_state.get(f'show_conv_{conv_id}', False):
-                        st.write("**Full Conversation:**")
-                        # Show related messages from same conversation
-                        conv_messages = [r for r in metadata_list if r.get('conversation_id') == conv_id]
-                        for msg in conv_messages:
-                            role_icon = "👤" if msg.get('role') == 'user' else "🤖"
-                            st.write(f"{role_icon} {msg.get('content', '')}")
-                    
-                    # Note input if requested
-                    if st.session_state.get(f'show_note_{conv_id}', False):
-                        note_text = st.text_area(f"Add note for conversation {conv_id}:", 
-                                               value=notes.get(conv_id, ''), 
-                                               key=f"note_input_{conv_id}")
-                        if st.button(f"Save Note", key=f"save_note_{i}"):
-                            notes[conv_id] = note_text
-                            save_notes(notes)
-                            st.success("Note saved!")
-                            st.session_state[f'show_note_{conv_id}'] = False
-                            st.rerun()
-                    
-                    st.markdown('</div>', unsafe_allow_html=True)
+            if results is None and not API_KEY_VALID:
+                st.warning("Please set a valid OpenAI API key in .env file")
+            elif results is None:
+                st.info("Could not embed your query. Please try again in a minute.")
+            elif not results:
+                st.info("No matching messages found. Try rephrasing or relaxing the filters.")
+            else:
+                st.subheader("📋 Search Results")
+                for i, (idx, score) in enumerate(results):
+                    render_search_result(i, metadata_list[idx], score)
         else:
             st.error("No data loaded. Please run the embedding script first.")
 
@@ -378,7 +596,9 @@ elif mode == "🗺️ Mind Map":
     st.header("🗺️ Conversation Mind Map")
     
     if metadata_list:
-        topics, keywords_map = cluster_conversations(metadata_list)
+        # Cluster by meaning when the index can hand back its vectors, by keywords otherwise
+        clusters = cluster_from_embeddings(index, metadata_list) if index is not None else None
+        topics, keywords_map = clusters or cluster_conversations(metadata_list)
         
         col1, col2 = st.columns([2, 1])
         
@@ -413,7 +633,7 @@ elif mode == "📝 Notes Manager":
             with col2:
                 if st.button(f"🗑️ Delete", key=f"del_{conv_id}"):
                     del notes[conv_id]
-                    save_notes(notes)
+                    save_note(conv_id, None)
                     st.rerun()
             
             st.markdown('</div>', unsafe_allow_html=True)
@@ -421,14 +641,18 @@ elif mode == "📝 Notes Manager":
         st.info("No notes saved yet. Add notes from the search results!")
 
 elif mode == "📊 Analytics":
+    import plotly.express as px
+    
     st.header("📊 Conversation Analytics")
     
     if metadata_list:
+        metadata_df = build_metadata_frame(metadata_list)
+        role_counts = metadata_df['role'].value_counts()
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
             st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-            st.metric("Total Conversations", len(set(r.get('conversation_id') for r in metadata_list)))
+            st.metric("Total Conversations", len(conv_index))
             st.markdown('</div>', unsafe_allow_html=True)
         
         with col2:
@@ -438,8 +662,7 @@ elif mode == "📊 Analytics":
         
         with col3:
             st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-            user_msgs = len([r for r in metadata_list if r.get('role') == 'user'])
-            st.metric("User Messages", user_msgs)
+            st.metric("User Messages", int(role_counts.get('user', 0)))
             st.markdown('</div>', unsafe_allow_html=True)
         
         with col4:
@@ -449,14 +672,10 @@ elif mode == "📊 Analytics":
         
         # Timeline chart
         st.subheader("📈 Message Timeline")
-        dates = []
-        for record in metadata_list:
-            if record.get('datetime_obj'):
-                dates.append(record['datetime_obj'].date())
+        dates = metadata_df['datetime_obj'].dropna()
         
-        if dates:
-            df = pd.DataFrame({'date': dates})
-            daily_counts = df.groupby('date').size().reset_index(name='count')
+        if not dates.empty:
+            daily_counts = dates.groupby(dates.dt.date).size().rename_axis('date').reset_index(name='count')
             fig = px.line(daily_counts, x='date', y='count', title='Messages per Day')
             st.plotly_chart(fig, use_container_width=True)
         else:
@@ -464,8 +683,6 @@ elif mode == "📊 Analytics":
         
         # Role distribution
         st.subheader("👥 Message Distribution")
-        roles = [r.get('role', 'unknown') for r in metadata_list]
-        role_counts = pd.Series(roles).value_counts()
         fig = px.pie(values=role_counts.values, names=role_counts.index, title='Messages by Role')
         st.plotly_chart(fig, use_container_width=True)
     else:
@@ -1,56 +1,110 @@
-import json
+import asyncio
+import hashlib
+import shelve
 import faiss
 import numpy as np
-from openai import OpenAI
+import orjson
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import os
 
 # Setup
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+client = AsyncOpenAI(api_key=api_key)
+
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_CACHE_PATH = "flattened_output/embed_cache" # shelve cache of query embeddings
+# Search-time recall/speed knobs for the ANN index built by embed_and_index.py
+HNSW_EF_SEARCH = 64 # Candidates explored per HNSW query
+IVF_NPROBE = 16 # Inverted lists visited per IVF query
+EMBED_BATCH_SIZE = 2048 # Max inputs per embeddings request
+MAX_CONCURRENT_REQUESTS = 8 # Embeddings requests in flight at once
+# OpenMP threads for FAISS search. Defaults to the CPUs this process may run on,
+# which inside a container can be far fewer than the host's os.cpu_count().
+FAISS_THREADS = int(os.getenv("FAISS_THREADS", len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1))
+# Index read flags: memory-mapped and read-only. IO_FLAG_MMAP alone only maps IVF lists;
+# IO_FLAG_MMAP_IFC (FAISS 1.11+) also maps flat/SQ code storage, e.g. the HNSW index's vectors.
+INDEX_READ_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
 
 # Load metadata and index
-with open("flattened_output/zain_metadata.json", "r") as f:
-    metadata = json.load(f)
+with open("flattened_output/zain_metadata.json", "rb") as f:
+    metadata = orjson.loads(f.read())
+
+# Memory-map the index read-only: pages are loaded on demand (and shared between
+# processes) instead of reading the whole file into RAM up front. Index types that
+# can't be mapped are read normally.
+faiss.omp_set_num_threads(FAISS_THREADS)
+index = faiss.read_index("flattened_output/zain_index.faiss", INDEX_READ_FLAGS)
+if hasattr(index, "hnsw"):
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+elif hasattr(index, "nprobe"):
+    index.nprobe = IVF_NPROBE
+
+# Search on the GPU when FAISS was built with GPU support and one is present.
+# Index types without a GPU implementation (e.g. HNSW) stay on the CPU.
+if faiss.get_num_gpus() > 0:
+    gpu_resources = faiss.StandardGpuResources()
+    try:
+        index = faiss.index_cpu_to_gpu(gpu_resources, 0, index)
+    except Exception as e:
+        print(f"ℹ️ Searching on CPU: {e}")
+
+# Embed queries: repeats come from the on-disk cache, the rest go out batched,
+# with the batches sent concurrently
+async def get_embeddings(texts, cache):
+    keys = [hashlib.sha1(f"{EMBED_MODEL}\0{text}".encode("utf-8")).hexdigest() for text in texts]
+    missing = list({key: text for key, text in zip(keys, texts) if key not in cache}.items())
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-index = faiss.read_index("flattened_output/zain_index.faiss")
+    async def embed_batch(batch):
+        async with semaphore:
+            response = await client.embeddings.create(model=EMBED_MODEL, input=[text for _, text in batch])
+        for (key, _), item in zip(batch, response.data):
+            cache[key] = np.array(item.embedding, dtype="float32")
+
+    await asyncio.gather(*(
+        embed_batch(missing[start:start + EMBED_BATCH_SIZE]) for start in range(0, len(missing), EMBED_BATCH_SIZE)
+    ))
+    return np.stack([cache[key] for key in keys])
 
 # Build CLI loop
-def query_loop():
-    while True:
-        query = input("\n🔍 Ask your brain: ").strip()
-        if not query:
-            print("⛔ Empty query. Try again.")
-            continue
-        if query.lower() in {"exit", "quit"}:
-            print("👋 Goodbye.")
-            break
-
-        # Embed query
-        try:
-            response = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=[query]
-            )
-            query_vector = np.array(response.data[0].embedding).astype("float32")
-        except Exception as e:
-            print(f"❌ Error embedding query: {e}")
-            continue
-
-        # Search FAISS
-        D, I = index.search(np.array([query_vector]), k=5)
-        print("\n🧠 Top Results:\n")
-        for idx, score in zip(I[0], D[0]):
-            if idx >= len(metadata):
+async def query_loop():
+    with shelve.open(EMBED_CACHE_PATH) as cache:
+        while True:
+            line = input("\n🔍 Ask your brain (separate several questions with ;): ").strip()
+            queries = [q.strip() for q in line.split(";") if q.strip()]
+            if not queries:
+                print("⛔ Empty query. Try again.")
+                continue
+            if line.lower() in {"exit", "quit"}:
+                print("👋 Goodbye.")
+                break
+
+            # Embed all queries at once
+            try:
+                query_vectors = await get_embeddings(queries, cache)
+            except Exception as e:
+                print(f"❌ Error embedding query: {e}")
                 continue
-            msg = metadata[idx]
-            print(f"[{idx}] Score: {score:.2f}")
-            print(f"→ Role: {msg['role']}")
-            print(f"→ Content:\n{msg['content'][:1000]}")
-            print("-" * 50)
+
+            # Search FAISS: vectors are unit-normalized, so inner-product scores are cosine similarities
+            faiss.normalize_L2(query_vectors)
+            D, I = index.search(query_vectors, k=5)
+            # Drop padding (-1) and stale ids for all queries in one vectorized mask
+            valid = (I >= 0) & (I < len(metadata))
+            for query, ids, scores, keep in zip(queries, I, D, valid):
+                header = f"\n🧠 Top Results for \"{query}\":\n" if len(queries) > 1 else "\n🧠 Top Results:\n"
+                blocks = [
+                    f"[{idx}] Score: {score:.2f}\n"
+                    f"→ Role: {metadata[idx]['role']}\n"
+                    f"→ Content:\n{metadata[idx]['content'][:1000]}\n"
+                    + "-" * 50
+                    for idx, score in zip(ids[keep], scores[keep])
+                ]
+                print("\n".join([header, *blocks]))
 
 # Start it
 if __name__ == "__main__":
-    query_loop()
+    asyncio.run(query_loop())
 
@@ -2,11 +2,22 @@ import streamlit as st
 import json
 import faiss
 import numpy as np
-from openai import OpenAI
+import orjson
+import hashlib
+import shelve
+import pyarrow as pa
+import pyarrow.compute as pc
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv
 import os
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime
 import re # For creating a safe filename
+from convert_metadata import build_metadata_table
 
 # --- Configuration and Setup ---
 st.set_page_config(page_title="Zain's Mind Search", layout="wide")
@@ -21,39 +32,95 @@ if not api_key:
     st.error("OPENAI_API_KEY not found in .env file. Please ensure it's set.")
     st.stop()
 
-client = OpenAI(api_key=api_key)
+# Streamlit re-executes this script on every interaction, so the client (and its
+# pool of open connections) is cached to be built once per server process
+@st.cache_resource
+def get_openai_client():
+    return OpenAI(api_key=api_key)
+
+client = get_openai_client()
 
 # Paths to your data
 METADATA_PATH = "flattened_output/zain_metadata.json"
+METADATA_ARROW_PATH = "flattened_output/zain_metadata.arrow" # Columnar copy written by convert_metadata.py
 INDEX_PATH = "flattened_output/zain_index.faiss"
 # Path for pre-calculated insights (will be used by batch script later)
-PRECALCULATED_INSIGHTS_PATH = "flattened_output/precalculated_insights.json" 
+PRECALCULATED_INSIGHTS_PATH = "flattened_output/precalculated_insights.json"
+SUMMARY_CACHE_PATH = "flattened_output/summary_cache" # shelve cache of on-demand insights keyed by input hash 
 
 EMBED_MODEL = "text-embedding-3-small"
+EMBED_BATCH_SIZE = 16 # Most queries (from all sessions) sent in one embeddings request
+EMBED_FLUSH_SECONDS = 0.05 # Longest a query waits for others to share its request
+QUERY_CACHE_ENTRIES = 1024 # Query embeddings kept in memory (about 6 KB each)
+EXPORT_CACHE_ENTRIES = 64 # Thread export texts kept in memory (one full transcript each)
+# Search-time recall/speed knobs for the ANN index built by embed_and_index.py
+RESULTS_SHOWN = 10 # Hits displayed per query; fetched exactly when no role filter is set
+FILTERED_SEARCH_K = 30 # Hits fetched when a role filter is set, leaving room for it to drop some
+# Candidates explored per HNSW query. FAISS explores max(efSearch, k), so this only has to clear
+# FILTERED_SEARCH_K: the filtered tail may be approximate, only the top RESULTS_SHOWN are displayed
+HNSW_EF_SEARCH = 32
+IVF_NPROBE = 16 # Inverted lists visited per IVF query
+# OpenMP threads for FAISS search. Defaults to the CPUs this process may run on,
+# which inside a container can be far fewer than the host's os.cpu_count().
+FAISS_THREADS = int(os.getenv("FAISS_THREADS", len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1))
+# Index read flags: memory-mapped and read-only. IO_FLAG_MMAP alone only maps IVF lists;
+# IO_FLAG_MMAP_IFC (FAISS 1.11+) also maps flat/SQ code storage, e.g. the HNSW index's vectors.
+INDEX_READ_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
 CHAT_MODEL_FOR_SUMMARY = "gpt-3.5-turbo"
 
 # --- Caching Functions to Load Data Once ---
 @st.cache_resource
-def load_all_metadata_list_version():
+def load_metadata_table():
+    """
+    Loads the metadata as an Arrow table. The Arrow copy from convert_metadata.py is
+    memory-mapped (zero-copy); if it is missing or older than the JSON file, the JSON is
+    parsed once and converted, so records are held columnar either way.
+    """
     try:
-        with open(METADATA_PATH, "r") as f:
-            metadata_list = json.load(f)
-        for record in metadata_list:
-            if record.get("timestamp"):
-                try:
-                    record["datetime_obj"] = datetime.fromtimestamp(float(record["timestamp"]))
-                except (ValueError, TypeError): record["datetime_obj"] = None
-            else: record["datetime_obj"] = None
-        return metadata_list
-    except FileNotFoundError: st.error(f"Metadata file not found: {METADATA_PATH}. Did you run embed_and_index.py?"); return []
-    except json.JSONDecodeError: st.error(f"Error decoding {METADATA_PATH}. File might be corrupt."); return []
+        if os.path.exists(METADATA_ARROW_PATH) and (
+            not os.path.exists(METADATA_PATH) or os.path.getmtime(METADATA_ARROW_PATH) >= os.path.getmtime(METADATA_PATH)
+        ):
+            return pa.ipc.open_file(pa.memory_map(METADATA_ARROW_PATH)).read_all()
+        with open(METADATA_PATH, "rb") as f:
+            return build_metadata_table(orjson.loads(f.read()))
+    except FileNotFoundError: st.error(f"Metadata file not found: {METADATA_PATH}. Did you run embed_and_index.py?"); return None
+    except orjson.JSONDecodeError: st.error(f"Error decoding {METADATA_PATH}. File might be corrupt."); return None
+
+@st.cache_resource
+def index_conversations(_metadata_table):
+    """Maps each conversation_id to its row numbers in timestamp order (rows without a timestamp are left out)."""
+    df = _metadata_table.select(["conversation_id", "timestamp"]).to_pandas()
+    df = df[df["conversation_id"].notna() & df["timestamp"].notna()].sort_values("timestamp", kind="stable")
+    return {conv_id: group.index.to_numpy() for conv_id, group in df.groupby("conversation_id", sort=False, observed=True)}
+
+def rows_to_messages(table):
+    """Materializes table rows as message dicts (timestamps stay raw floats until displayed)."""
+    return table.to_pylist()
 
 @st.cache_resource
 def load_faiss_index():
+    """
+    Memory-maps the index read-only so vectors are paged in on demand and shared
+    across processes; index types that can't be mapped are read normally.
+    """
+    faiss.omp_set_num_threads(FAISS_THREADS)
     try:
-        return faiss.read_index(INDEX_PATH)
+        index = faiss.read_index(INDEX_PATH, INDEX_READ_FLAGS)
     except Exception as e:
         st.error(f"FAISS index file not found or could not be read: {INDEX_PATH}. Error: {e}"); return None
+    if hasattr(index, "hnsw"): index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif hasattr(index, "nprobe"): index.nprobe = IVF_NPROBE
+    # Search on the GPU when FAISS has GPU support and one is present; index types
+    # without a GPU implementation (e.g. HNSW) stay on the CPU
+    if faiss.get_num_gpus() > 0:
+        try: index = faiss.index_cpu_to_gpu(load_gpu_resources(), 0, index)
+        except Exception: pass
+    return index
+
+@st.cache_resource
+def load_gpu_resources():
+    """FAISS GPU scratch memory, allocated once per server process."""
+    return faiss.StandardGpuResources()
 
 @st.cache_resource
 def load_precalculated_insights():
@@ -70,88 +137,214 @@ def load_precalculated_insights():
             return {}
     return {} # Return empty dict if file doesn't exist
 
+@st.cache_resource
+def load_embedding_batcher():
+    """
+    Starts one background thread per server process that coalesces queries from all
+    sessions: whatever arrives within EMBED_FLUSH_SECONDS (up to EMBED_BATCH_SIZE) goes
+    out as a single embeddings request, and each caller's Future gets its own vector.
+    """
+    pending = queue.Queue()
+
+    def run():
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + EMBED_FLUSH_SECONDS
+            while len(batch) < EMBED_BATCH_SIZE:
+                try: batch.append(pending.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty: break
+            try:
+                response = client.embeddings.create(input=[text for text, _ in batch], model=EMBED_MODEL)
+                # One float32 matrix per request, normalized once; each caller gets a
+                # (1, d) row view that goes straight into index.search
+                vectors = np.array([item.embedding for item in response.data], dtype="float32")
+                faiss.normalize_L2(vectors)
+                for i, (_, future) in enumerate(batch):
+                    future.set_result(vectors[i:i + 1])
+            except Exception as e:
+                for _, future in batch: future.set_exception(e)
+
+    threading.Thread(target=run, name="embedding-batcher", daemon=True).start()
+    return pending
+
 # --- Helper Functions ---
-def get_embedding(text, model=EMBED_MODEL):
+# Every widget interaction reruns the script with the same query, so its embedding is cached,
+# on disk so repeat questions stay free across restarts (the cached copy is still a C-contiguous
+# (1, d) float32 array). model is only part of the key: the persisted cache must not serve vectors
+# from a previous EMBED_MODEL. Errors raise and aren't cached.
+@st.cache_data(max_entries=QUERY_CACHE_ENTRIES, persist="disk", show_spinner=False)
+def embed_query(text, model):
+    future = Future()
+    load_embedding_batcher().put((text, future))
+    return future.result()
+
+def get_embedding(text):
+    """Returns the query's unit-normalized embedding as a (1, d) float32 array, or None on error."""
     try:
-        response = client.embeddings.create(input=[text], model=model)
-        return np.array(response.data[0].embedding).astype("float32")
+        return embed_query(text, EMBED_MODEL)
     except Exception as e:
         st.error(f"Error getting embedding: {e}"); return None
 
-@st.cache_data # Cache based on arguments
-def get_full_conversation_messages(_conversation_id, _all_metadata_list):
-    """Retrieves all messages for a given conversation_id, sorted by timestamp."""
-    if not _all_metadata_list or not _conversation_id: return []
-    
-    conversation_messages = [
-        msg for msg in _all_metadata_list
-        if msg.get("conversation_id") == _conversation_id and msg.get("datetime_obj") is not None
-    ]
-    conversation_messages.sort(key=lambda x: x["datetime_obj"])
-    return conversation_messages
-
-@st.cache_data
-def generate_summary_and_keywords_on_demand(_conversation_text_for_llm, _conversation_id):
-    """On-demand summary and keyword generation if not pre-calculated."""
-    if not _conversation_text_for_llm: return None, None
-    try:
-        system_prompt = (
-            "You are an expert at summarizing conversations and extracting key topics. "
-            "Analyze the following conversation transcript. "
-            "Provide a concise one-sentence summary of the entire conversation. "
-            "Then, list the 5 most important and distinct keywords or keyphrases from the conversation. "
-            "Format your response as follows:\n"
-            "SUMMARY: [Your one-sentence summary here]\n"
-            "KEYWORDS: [keyword1, keyword2, keyword3, keyword4, keyword5]"
-        )
-        response = client.chat.completions.create(
-            model=CHAT_MODEL_FOR_SUMMARY,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": _conversation_text_for_llm}
-            ],
-            temperature=0.3, max_tokens=200
-        )
-        content = response.choices[0].message.content
-        summary_line, keywords_line = "", ""
-        for line in content.split('\n'):
-            if line.upper().startswith("SUMMARY:"): summary_line = line.replace("SUMMARY:", "").strip()
-            elif line.upper().startswith("KEYWORDS:"): keywords_line = line.replace("KEYWORDS:", "").strip()
-        keywords_list = [kw.strip() for kw in keywords_line.split(',') if kw.strip()] if keywords_line else []
-        return summary_line, keywords_list
-    except Exception as e:
-        st.error(f"Error generating on-demand insights for thread {_conversation_id}: {e}"); return None, None
+def get_full_conversation_messages(conversation_id, metadata_table, conversation_rows):
+    """Retrieves all messages for a given conversation_id, sorted by timestamp (a dict lookup plus a take)."""
+    if metadata_table is None or not conversation_id: return []
+    rows = conversation_rows.get(conversation_id)
+    if rows is None: return []
+    return rows_to_messages(metadata_table.take(rows))
+
+def thread_text_for_llm(messages):
+    """Flattens a thread into the "User: ..." / "Assistant: ..." transcript sent for summarizing."""
+    return "\n".join(f"{'User' if msg.get('role') == 'user' else 'Assistant'}: {msg.get('content')}" for msg in messages)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You are an expert at summarizing conversations and extracting key topics. "
+    "Analyze the following conversation transcript. "
+    "Provide a concise one-sentence summary of the entire conversation. "
+    "Then, list the 5 most important and distinct keywords or keyphrases from the conversation. "
+    "Format your response as follows:\n"
+    "SUMMARY: [Your one-sentence summary here]\n"
+    "KEYWORDS: [keyword1, keyword2, keyword3, keyword4, keyword5]"
+)
+
+def summary_request(conversation_text_for_llm):
+    """Chat completion arguments shared by the sync and async summary calls."""
+    return dict(
+        model=CHAT_MODEL_FOR_SUMMARY,
+        messages=[
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": conversation_text_for_llm}
+        ],
+        temperature=0.3, max_tokens=200
+    )
+
+# "SUMMARY: ..." / "KEYWORDS: ..." lines of the model's reply, in any case
+INSIGHT_LINE_PATTERN = re.compile(r'^(SUMMARY|KEYWORDS):[ \t]*(.*?)[ \t]*$', re.I | re.M)
 
-def format_timestamp(dt_obj):
-    if dt_obj: return dt_obj.strftime('%a - %b %d @ %I:%M %p').upper()
+def parse_summary_response(content):
+    fields = {label.upper(): value for label, value in INSIGHT_LINE_PATTERN.findall(content)}
+    summary_line, keywords_line = fields.get("SUMMARY", ""), fields.get("KEYWORDS", "")
+    keywords_list = [kw.strip() for kw in keywords_line.split(',') if kw.strip()] if keywords_line else []
+    return summary_line, keywords_list
+
+# On-demand insights are kept on disk so a thread is summarized once across restarts.
+# Sessions run on separate threads, so the shelf is shared behind a lock.
+@st.cache_resource
+def load_summary_cache():
+    return shelve.open(SUMMARY_CACHE_PATH), threading.Lock()
+
+def summary_cache_key(conversation_text_for_llm):
+    """Hashes the exact LLM input, so the key changes whenever the model, prompt or thread does."""
+    return hashlib.sha256(f"{CHAT_MODEL_FOR_SUMMARY}\0{SUMMARY_SYSTEM_PROMPT}\0{conversation_text_for_llm}".encode("utf-8")).hexdigest()
+
+def get_cached_summary(conversation_text_for_llm):
+    """Returns the cached (summary, keywords) for this thread text, or None."""
+    cache, lock = load_summary_cache()
+    with lock: return cache.get(summary_cache_key(conversation_text_for_llm))
+
+def insights_from_reply(conversation_text_for_llm, reply):
+    """
+    Parses a model reply into (summary, keywords) and caches it. Returns None, caching
+    nothing, when the reply is missing (e.g. a refusal) or has neither field.
+    """
+    if not reply: return None
+    summary, keywords = parse_summary_response(reply)
+    if not summary and not keywords: return None
+    cache, lock = load_summary_cache()
+    with lock:
+        cache[summary_cache_key(conversation_text_for_llm)] = (summary, keywords)
+        cache.sync()
+    return summary, keywords
+
+def stream_summary_reply(conversation_text_for_llm):
+    """Yields the summary reply's text as the model produces it."""
+    response = client.chat.completions.create(**summary_request(conversation_text_for_llm), stream=True)
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content: yield chunk.choices[0].delta.content
+
+def generate_summary_and_keywords_on_demand(conversation_text_for_llm, placeholder):
+    """
+    On-demand summary and keyword generation if not pre-calculated; a new reply streams into
+    placeholder. Returns (summary, keywords), or None if the model gave no usable reply.
+    """
+    if not conversation_text_for_llm: return None
+    cached = get_cached_summary(conversation_text_for_llm)
+    if cached: return cached
+    reply = placeholder.write_stream(stream_summary_reply(conversation_text_for_llm))
+    placeholder.empty() # The parsed summary and keywords are shown in its place
+    return insights_from_reply(conversation_text_for_llm, reply if isinstance(reply, str) else "")
+
+async def summarize_threads(texts_by_conversation):
+    """
+    Summarizes several threads with all requests in flight at once, so the wait is one
+    round-trip rather than one per thread. Returns {conversation_id: reply text (None if the model
+    gave no content) or exception}.
+    The async client is made per call: its connection pool belongs to this asyncio.run's event loop.
+    """
+    async with AsyncOpenAI(api_key=api_key) as aclient:
+        async def summarize(text):
+            response = await aclient.chat.completions.create(**summary_request(text))
+            return response.choices[0].message.content
+        results = await asyncio.gather(*(summarize(text) for text in texts_by_conversation.values()), return_exceptions=True)
+    return dict(zip(texts_by_conversation, results))
+
+def format_timestamp(ts):
+    if ts: return datetime.fromtimestamp(ts).strftime('%a - %b %d @ %I:%M %p').upper()
     return "No Timestamp"
 
-def format_role_for_display(role, dt_obj):
-    formatted_ts = format_timestamp(dt_obj)
+def format_role_for_display(role, ts):
+    formatted_ts = format_timestamp(ts)
     if role == 'user': return f"Zain asked on {formatted_ts}"
     return f"OpenAI Model responded on {formatted_ts}"
 
+def close_code_fences(content):
+    """Closes a dangling ``` fence so one message can't swallow the rest of a joined markdown block."""
+    if content and content.count("```") % 2: return f"{content}\n```"
+    return content
+
+# Compiled once: create_safe_filename runs for every export button on every rerun
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w\s-]') # Non-alphanumeric, non-space, non-hyphen
+FILENAME_SEPARATORS = re.compile(r'[-\s]+') # Runs of spaces/hyphens
+
 def create_safe_filename(base_name):
     """Creates a safe filename by removing invalid characters."""
-    base_name = re.sub(r'[^\w\s-]', '', base_name) # Remove non-alphanumeric, non-space, non-hyphen
-    base_name = re.sub(r'[-\s]+', '-', base_name).strip('-_') # Replace spaces/hyphens with single hyphen
+    base_name = UNSAFE_FILENAME_CHARS.sub('', base_name)
+    base_name = FILENAME_SEPARATORS.sub('-', base_name).strip('-_') # Replace spaces/hyphens with single hyphen
     return f"{base_name[:50]}.txt" # Truncate and add extension
 
+# download_button needs its data up front and expander bodies run on every rerun, opened or not,
+# so the transcript is formatted once per thread and reused (summary/keywords are appended by the caller)
+@st.cache_data(max_entries=EXPORT_CACHE_ENTRIES, show_spinner=False)
+def build_thread_export(conversation_id, _messages):
+    """Returns (export text, safe filename) for a thread."""
+    export_text = "\n\n".join(
+        [f"{format_role_for_display(msg.get('role'), msg.get('timestamp'))}:\n{msg.get('content')}" for msg in _messages]
+    )
+    export_filename_base = f"conversation_{conversation_id}"
+    # Use first few words of first user message for a more descriptive filename
+    first_user_msg_content = next((msg.get("content") for msg in _messages if msg.get("role") == "user"), None)
+    if first_user_msg_content:
+        export_filename_base = f"conv_{conversation_id}_{first_user_msg_content[:20]}"
+    return export_text, create_safe_filename(export_filename_base)
+
 # --- Load Data ---
-metadata_list_for_faiss = load_all_metadata_list_version()
+metadata_table = load_metadata_table()
 index = load_faiss_index()
 precalculated_insights = load_precalculated_insights() # Load pre-calculated insights
 
-if not metadata_list_for_faiss or not index:
+if metadata_table is None or metadata_table.num_rows == 0 or not index:
     st.warning("Core data (metadata or FAISS index) not loaded. Please check errors and ensure `embed_and_index.py` ran successfully.")
     st.stop()
 
+# Built once per server process, so opening a thread never scans the metadata
+conversation_rows = index_conversations(metadata_table)
+
 # --- Streamlit App UI ---
 # Sidebar for filters
 st.sidebar.header("🔎 Filter Options")
+ROLE_FILTERS = {"User (Zain)": "user", "Assistant (OpenAI)": "assistant"} # Option -> role column value
 filter_role = st.sidebar.selectbox(
     "Filter by Role (in hit message):",
-    ["Any", "User (Zain)", "Assistant (OpenAI)"],
+    ["Any", *ROLE_FILTERS],
     key="filter_role_select"
 )
 
@@ -165,59 +358,87 @@ if search_query:
 
     if query_vector is not None:
         try:
-            D, I = index.search(np.array([query_vector]), k=20) # Fetch more results initially for filtering
+            # Both sides are unit-normalized, so scores are cosine similarities
+            search_k = FILTERED_SEARCH_K if filter_role in ROLE_FILTERS else RESULTS_SHOWN # Oversample only to filter
+            D, I = index.search(query_vector, k=search_k)
             
             if I[0].size == 0 or I[0][0] == -1:
                  st.info("No relevant thoughts initially found for your query. Try rephrasing.")
             else:
-                results_to_display = []
-                for i, idx in enumerate(I[0]):
-                    if idx < 0 or idx >= len(metadata_list_for_faiss): continue
-                    
-                    hit_message = metadata_list_for_faiss[idx]
-                    score = D[0][i]
-
-                    # Apply role filter
-                    if filter_role == "User (Zain)" and hit_message.get('role') != 'user':
-                        continue
-                    if filter_role == "Assistant (OpenAI)" and hit_message.get('role') != 'assistant':
-                        continue
-                    
-                    results_to_display.append({"hit_message": hit_message, "score": score, "original_faiss_idx": idx})
+                ids, scores = I[0], D[0]
+                keep = (ids >= 0) & (ids < metadata_table.num_rows)
+                ids, scores = ids[keep], scores[keep]
+
+                # Apply role filter to all hits at once on the role column
+                if filter_role in ROLE_FILTERS:
+                    hit_roles = metadata_table.column("role").take(ids).cast(pa.string())
+                    keep = pc.fill_null(pc.equal(hit_roles, ROLE_FILTERS[filter_role]), False).to_numpy(zero_copy_only=False)
+                    ids, scores = ids[keep], scores[keep]
+
+                # Only the rows that will be shown are materialized, in one take
+                ids, scores = ids[:RESULTS_SHOWN], scores[:RESULTS_SHOWN]
+                results_to_display = [
+                    {"hit_message": hit_message, "score": score, "original_faiss_idx": idx}
+                    for hit_message, score, idx in zip(rows_to_messages(metadata_table.take(ids)), scores, ids)
+                ]
 
                 if not results_to_display:
                     st.info(f"No results match your query combined with the role filter: '{filter_role}'.")
                 else:
                     st.subheader(f"💡 Top Matching Thoughts (Filtered by Role: {filter_role})")
-                    for i, res_data in enumerate(results_to_display[:10]): # Display top 10 after filtering
+
+                    # Summarize every shown thread that has no insights yet in one concurrent round
+                    thread_insights = st.session_state.setdefault("thread_insights", {})
+                    missing_ids = list(dict.fromkeys(
+                        res_data["hit_message"].get("conversation_id") for res_data in results_to_display
+                    ))
+                    missing_ids = [c for c in missing_ids if c and c not in precalculated_insights and c not in thread_insights]
+                    if missing_ids and st.button(f"✨ Generate Insights for All {len(missing_ids)} Threads Shown", key="ondemand_insight_all"):
+                        with st.spinner(f"Generating insights for {len(missing_ids)} threads..."):
+                            texts = {c: thread_text_for_llm(get_full_conversation_messages(c, metadata_table, conversation_rows)) for c in missing_ids}
+                            texts = {c: text for c, text in texts.items() if text}
+                            for conv_id in list(texts): # Threads summarized before come from the disk cache
+                                cached = get_cached_summary(texts[conv_id])
+                                if cached:
+                                    thread_insights[conv_id] = cached
+                                    del texts[conv_id]
+                            for conv_id, result in asyncio.run(summarize_threads(texts)).items():
+                                if isinstance(result, Exception):
+                                    st.warning(f"Error generating insights for thread {conv_id}: {result}")
+                                    continue
+                                insights = insights_from_reply(texts[conv_id], result)
+                                if insights: thread_insights[conv_id] = insights
+                                else: st.warning(f"Summary unavailable for thread {conv_id}: the model returned no usable reply.")
+
+                    for i, res_data in enumerate(results_to_display):
                         hit_message = res_data["hit_message"]
                         score = res_data["score"]
                         original_faiss_idx = res_data["original_faiss_idx"] # For unique keys
 
                         st.markdown(f"**Result {i+1} (Score: {score:.2f})**")
                         
-                        hit_display_role_ts = format_role_for_display(hit_message.get('role'), hit_message.get('datetime_obj'))
+                        hit_display_role_ts = format_role_for_display(hit_message.get('role'), hit_message.get('timestamp'))
                         st.markdown(f"🎯 **Hit Message ({hit_display_role_ts}):** {hit_message.get('content')}")
 
                         conversation_id = hit_message.get("conversation_id")
                         if conversation_id:
                             expander_title = f"🔍 View Full Conversation & Insights (ID: {conversation_id}, Hit: '{hit_message.get('content', '')[:30].strip()}...')"
                             with st.expander(expander_title):
-                                full_thread_messages = get_full_conversation_messages(conversation_id, metadata_list_for_faiss)
-                                conversation_text_for_llm_parts = []
+                                full_thread_messages = get_full_conversation_messages(conversation_id, metadata_table, conversation_rows)
 
                                 if full_thread_messages:
                                     st.markdown("##### Entire Conversation Thread:")
+                                    hit_message_id = hit_message.get("message_id")
+                                    # One markdown element for the whole thread instead of one per message
+                                    thread_lines = []
                                     for ctx_msg in full_thread_messages:
-                                        display_role_ts_ctx = format_role_for_display(ctx_msg.get('role'), ctx_msg.get('datetime_obj'))
-                                        
-                                        if ctx_msg.get("message_id") == hit_message.get("message_id"):
-                                            st.markdown(f"**➡️ {display_role_ts_ctx}: {ctx_msg.get('content')}**")
+                                        display_role_ts_ctx = format_role_for_display(ctx_msg.get('role'), ctx_msg.get('timestamp'))
+                                        content = close_code_fences(ctx_msg.get('content'))
+                                        if hit_message_id is not None and ctx_msg.get("message_id") == hit_message_id:
+                                            thread_lines.append(f"**➡️ {display_role_ts_ctx}: {content}**")
                                         else:
-                                            st.markdown(f"    {display_role_ts_ctx}: {ctx_msg.get('content')}")
-                                        
-                                        simple_role_prefix = "User" if ctx_msg.get('role') == 'user' else "Assistant"
-                                        conversation_text_for_llm_parts.append(f"{simple_role_prefix}: {ctx_msg.get('content')}")
+                                            thread_lines.append(f"↳ {display_role_ts_ctx}: {content}") # No leading whitespace: it would start a code block
+                                    st.markdown("\n\n".join(thread_lines))
                                     
                                     st.markdown("---")
                                     # Insights Section
@@ -229,12 +450,16 @@ if search_query:
                                         summary = insights.get("summary")
                                         keywords = insights.get("keywords")
                                         st.caption("(Insights loaded from pre-calculated data)")
+                                    elif conversation_id in thread_insights: # Generated earlier this session
+                                        summary, keywords = thread_insights[conversation_id]
                                     
                                     if not summary and not keywords: # If not pre-calculated or failed to load
                                         if st.button(f"Generate Insights Now for Thread {conversation_id}", key=f"ondemand_insight_{conversation_id}_{original_faiss_idx}"):
-                                            with st.spinner("Generating insights on-demand..."):
-                                                full_conversation_text = "\n".join(conversation_text_for_llm_parts)
-                                                summary, keywords = generate_summary_and_keywords_on_demand(full_conversation_text, conversation_id)
+                                            try:
+                                                insights = generate_summary_and_keywords_on_demand(thread_text_for_llm(full_thread_messages), st.empty())
+                                                if insights: summary, keywords = thread_insights[conversation_id] = insights
+                                                else: st.warning(f"Summary unavailable for thread {conversation_id}: the model returned no usable reply.")
+                                            except Exception as e: st.error(f"Error generating on-demand insights for thread {conversation_id}: {e}")
                                     
                                     if summary: st.markdown(f"**📝 Summary:** {summary}")
                                     else: st.write("No summary available or generated yet for this thread.")
@@ -244,23 +469,14 @@ if search_query:
 
                                     # Export Button
                                     st.markdown("---")
-                                    full_conversation_text_for_export = "\n\n".join(
-                                        [f"{format_role_for_display(msg.get('role'), msg.get('datetime_obj'))}:\n{msg.get('content')}" for msg in full_thread_messages]
-                                    )
+                                    full_conversation_text_for_export, export_filename = build_thread_export(conversation_id, full_thread_messages)
                                     if summary: full_conversation_text_for_export += f"\n\n--- SUMMARY ---\n{summary}"
                                     if keywords: full_conversation_text_for_export += f"\n\n--- KEYWORDS ---\n{', '.join(keywords)}"
-                                    
-                                    export_filename_base = f"conversation_{conversation_id}"
-                                    if full_thread_messages:
-                                        # Use first few words of first user message for a more descriptive filename
-                                        first_user_msg_content = next((msg.get("content") for msg in full_thread_messages if msg.get("role") == "user"), None)
-                                        if first_user_msg_content:
-                                            export_filename_base = f"conv_{conversation_id}_{first_user_msg_content[:20]}"
 
                                     st.download_button(
                                         label="📥 Export this Thread (Text)",
                                         data=full_conversation_text_for_export,
-                                        file_name=create_safe_filename(export_filename_base),
+                                        file_name=export_filename,
                                         mime="text/plain",
                                         key=f"export_{conversation_id}_{original_faiss_idx}"
                                     )
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+from build_convo_index import message_dates
+
+def frame(timestamps, create_times=None):
+    return pd.DataFrame({
+        "role": "user",
+        "content": "hi",
+        "timestamp": timestamps,
+        "create_time": create_times if create_times is not None else [None] * len(timestamps),
+    })
+
+def test_mixed_shape_iso_timestamps_are_all_parsed():
+    df = frame([
+        "2024-03-01T10:15:30.123456",
+        "2024-03-02T08:00:00",
+        "2024-03-03T23:30:00+00:00",
+    ])
+    assert message_dates(df).tolist() == ["2024-03-01", "2024-03-02", "2024-03-03"]
+
+def local_date(seconds):
+    return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d")
+
+def test_offset_timestamps_keep_the_date_as_written():
+    df = frame(["2024-03-03T23:30:00-05:00", "2024-03-04T00:30:00+09:00", "2024-03-05"])
+    assert message_dates(df).tolist() == ["2024-03-03", "2024-03-04", "2024-03-05"]
+
+def test_unix_seconds_use_local_dates_mixed_with_iso_strings():
+    df = frame([1709251200, "2024-03-02T08:00:00", 1709424000.5])
+    assert message_dates(df).tolist() == [local_date(1709251200), "2024-03-02", local_date(1709424000.5)]
+
+def test_invalid_iso_strings_are_unknown():
+    df = frame(["2024-03-03Tnot-a-time", "2024-13-01"])
+    assert message_dates(df).tolist() == ["unknown", "unknown"]
+
+def test_create_time_fallback_and_unparseable_values():
+    df = frame(["", None, "not a date", 0], create_times=["2024-03-05T12:00:00Z", None, None, "2024-03-06"])
+    assert message_dates(df).tolist() == ["2024-03-05", "unknown", "unknown", "2024-03-06"]